@@ -0,0 +1,25 @@
+/*
+ * Client-side markers of the dl.GeoJSON layer built by geojson_layer.py.
+ * Features carry {id, direct, sel}; styles come from the layer's hideout.
+ */
+window.sosLayers = {
+    pointToLayer: function (feature, latlng, context) {
+        const props = feature.properties;
+        const style = context.props.hideout;
+        const base = props.sel ? style.selected : style.context;
+        const opacity = props.direct
+            ? style.direct_opacity
+            : style.indirect_opacity;
+
+        const marker = L.circleMarker(latlng, {
+            radius: base.radius,
+            color: base.color,
+            weight: base.weight,
+            fillColor: base.color,
+            fillOpacity: opacity,
+            opacity: opacity,
+        });
+        marker.bindTooltip("place_id: " + props.id);
+        return marker;
+    },
+};
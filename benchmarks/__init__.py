@@ -0,0 +1,3 @@
+"""
+benchmarks: Performance harnesses for the selection pipeline
+"""
@@ -0,0 +1,138 @@
+"""
+bench_maxheap.py: Micro-benchmark of `maxheap.Maxheap` against the former
+sorted-array implementation
+
+Usage: python -m benchmarks.bench_maxheap [--sizes 1000 10000 ...]
+"""
+
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from maxheap import Maxheap
+from metrics import euclidean
+
+
+class ArrayMaxheap:
+    """The sorted NumPy array stack `Maxheap` used to be, kept as baseline"""
+
+    def __init__(self, id, lat, lon, gain, iter):
+        sort_idx = np.argsort(gain)[::-1]
+
+        self.float_stack = np.array([lat, lon, gain], dtype=np.float32).T
+        self.int_stack = np.array([id, iter], dtype=np.int32).T
+
+        self.float_stack = self.float_stack[sort_idx]
+        self.int_stack = self.int_stack[sort_idx]
+
+    def __len__(self):
+        return len(self.int_stack)
+
+    def poptop(self):
+        top = (self.int_stack[:1, :], self.float_stack[:1, :])
+        self.int_stack = self.int_stack[1:, :]
+        self.float_stack = self.float_stack[1:, :]
+        return top
+
+    def insert(self, int_arr, float_arr):
+        if len(self.float_stack) == 0:
+            insert_idx = 0
+        elif self.float_stack[-1, 2] > float_arr[0, 2]:
+            insert_idx = len(self)
+        else:
+            insert_idx = np.argmax(self.float_stack[:, 2] < float_arr[0, 2])
+
+        self.int_stack = np.insert(self.int_stack, insert_idx, int_arr, 0)
+        self.float_stack = np.insert(
+            self.float_stack, insert_idx, float_arr, 0
+        )
+
+    def delete(self, arr):
+        keep_idx = ~np.isin(self.int_stack[:, 0], arr)
+        self.int_stack = self.int_stack[keep_idx]
+        self.float_stack = self.float_stack[keep_idx]
+
+    def delete_neighbors(self, lat, lon, radius):
+        stack_lat = self.float_stack[:, 0]
+        stack_lon = self.float_stack[:, 1]
+
+        index_keep = euclidean(lat, lon, stack_lat, stack_lon) > radius
+
+        self.int_stack = self.int_stack[index_keep]
+        self.float_stack = self.float_stack[index_keep]
+
+
+def run_heap(heap_class, n, n_ops, seed=0):
+    """Times the operations `greedy_sos` performs on a heap of `n` records"""
+    rng = np.random.default_rng(seed)
+    place_id = rng.choice(np.iinfo(np.int32).max, n, replace=False)
+    lat = rng.random(n) * 180 - 90
+    lon = rng.random(n) * 360 - 180
+    gain = rng.random(n)
+
+    timing = {}
+
+    start = perf_counter()
+    heap = heap_class(place_id, lat, lon, gain, np.zeros(n))
+    timing["build"] = perf_counter() - start
+
+    # lazy re-evaluation: pop the top, lower its gain and push it back
+    start = perf_counter()
+    for i in range(n_ops):
+        t_ints, t_floats = heap.poptop()
+        t_ints[0, 1] += 1
+        t_floats[0, 2] *= 0.5
+        heap.insert(t_ints, t_floats)
+    timing["reinsert"] = (perf_counter() - start) / n_ops
+
+    start = perf_counter()
+    for _ in range(n_ops):
+        heap.poptop()
+    timing["poptop"] = (perf_counter() - start) / n_ops
+
+    delete_id = rng.choice(place_id, min(n_ops, n // 2), replace=False)
+    start = perf_counter()
+    for pid in delete_id:
+        heap.delete([pid])
+    timing["delete"] = (perf_counter() - start) / len(delete_id)
+
+    n_neighbor_ops = min(n_ops, 100)
+    start = perf_counter()
+    for i in range(n_neighbor_ops):
+        heap.delete_neighbors(lat[i], lon[i], 0.5)
+    timing["delete_neighbors"] = (perf_counter() - start) / n_neighbor_ops
+
+    return timing
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1_000, 10_000, 100_000, 1_000_000],
+    )
+    parser.add_argument("--ops", type=int, default=1000)
+    args = parser.parse_args()
+
+    print(
+        f"{'class':>12} {'n':>9} {'build':>10} {'reinsert':>10} "
+        f"{'poptop':>10} {'delete':>10} {'del_nbrs':>10}"
+    )
+    for n in args.sizes:
+        for heap_class in [ArrayMaxheap, Maxheap]:
+            timing = run_heap(heap_class, n, min(args.ops, n // 2))
+            print(
+                f"{heap_class.__name__:>12} {n:>9} "
+                f"{timing['build'] * 1e3:>8.2f}ms "
+                f"{timing['reinsert'] * 1e6:>8.2f}us "
+                f"{timing['poptop'] * 1e6:>8.2f}us "
+                f"{timing['delete'] * 1e6:>8.2f}us "
+                f"{timing['delete_neighbors'] * 1e6:>8.2f}us"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,426 @@
+"""
+evaluate.py: Quality versus latency of the selection strategies
+
+Replays viewport sequences (zoom in, zoom out, pan) for sampled users with
+each strategy of `STRATEGIES`. For every viewport it records Score(S|O) of
+the selection over the places in view, the separation of the selected
+places, their overlap with the exact `isos` result, and the wall time and
+peak memory of the call. The report compares each strategy with the exact
+one and names the fastest strategy whose score stays within a tolerance.
+
+Users are synthetic (`benchmarks.synthetic.generate_relevant`) unless a
+store is given, then they are sampled among its users.
+
+Usage:
+    python -m benchmarks.evaluate --users 5 --places 20000 --output eval.json
+    python -m benchmarks.evaluate --store data/store --users 20 --report a.md
+    python -m benchmarks.evaluate --strategies random stochastic+sampled
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import tracemalloc
+from datetime import datetime, timezone
+from time import perf_counter
+
+import numpy as np
+
+from benchmarks.run import densest_point, git_commit, viewport
+from benchmarks.synthetic import generate_relevant
+from metrics import get_metric, pairwise_distance
+from object_selection import (
+    Approximation,
+    Deadline,
+    calc_score_OS,
+    isos,
+    random_selection,
+    update_sim_oS,
+)
+from osgenerator import OSGenerator
+from precompute import load_relevant
+from pyramid import SelectionPyramid
+from selection_state import SelectionState
+from session_store import PlaceSession
+
+EXACT = "exact"
+
+
+def with_isos(per_call=dict, per_user=lambda k: {}):
+    """Strategy calling `isos` with the keyword arguments of `per_user(k)`,
+    made once per user, and of `per_call()`, made before every call"""
+
+    def strategy(session, k):
+        user_options = per_user(k)
+
+        def select(prev, view, D, G):
+            return isos(
+                session.df_places,
+                session.visitors,
+                prev,
+                view,
+                k,
+                list(D),
+                list(G),
+                index=session.index,
+                **user_options,
+                **per_call(),
+            )
+
+        return select
+
+    return strategy
+
+
+def pyramid_strategy(session, k):
+    # the tiles are built beforehand, as the app does in the background
+    pyramid = SelectionPyramid(k)
+    for views in viewport_sequences(session.df_places).values():
+        for view in views:
+            pyramid.build(
+                session.df_places, session.visitors, session.index, view
+            )
+    return with_isos(per_user=lambda k: {"pyramid": pyramid})(session, k)
+
+
+def random_strategy(session, k):
+    def select(prev, view, D, G):
+        selected, unselected = random_selection(session.df_places, view, k)
+        return list(selected), list(unselected)
+
+    return select
+
+
+STRATEGIES = {
+    EXACT: with_isos(),
+    "random": random_strategy,
+    "state": with_isos(per_user=lambda k: {"state": SelectionState()}),
+    "pyramid": pyramid_strategy,
+    "deadline=0.05": with_isos(lambda: {"deadline": Deadline(0.05)}),
+    "deadline=0.2": with_isos(lambda: {"deadline": Deadline(0.2)}),
+    "stochastic": with_isos(lambda: {"approx": Approximation(epsilon=0.1)}),
+    "stochastic+sampled": with_isos(
+        lambda: {"approx": Approximation(epsilon=0.1, sample_size=2000)}
+    ),
+}
+
+
+def viewport_sequences(df_places) -> dict:
+    """The sequences of `bench_isos`, around the densest place cluster"""
+    lat, lon = densest_point(df_places)
+    heights = [40, 20, 10, 5, 2.5]
+    return {
+        "zoom_in": [viewport(lat, lon, h) for h in heights],
+        "zoom_out": [viewport(lat, lon, h) for h in heights[::-1]],
+        "pan": [viewport(lat, lon + 2 * i, 5) for i in range(5)],
+    }
+
+
+def synthetic_users(n_users: int, n_places: int, seed: int):
+    for i in range(n_users):
+        df_places, visitors = generate_relevant(n_places, seed=seed + i)
+        yield i, df_places, visitors
+
+
+def store_users(store_dir: str, n_users: int, k: int, seed: int):
+    """Users of the store in random order, skipping those with fewer than
+    `k` relevant places"""
+    osgen = OSGenerator()
+    osgen.read_from_store(store_dir)
+    rng = np.random.default_rng(seed)
+
+    n_yielded = 0
+    for user in rng.permutation(osgen.friend_index.keys):
+        if n_yielded == n_users:
+            return
+        relevant = load_relevant(store_dir, int(user))
+        if relevant is not None:
+            df_places, visitors, _ = relevant
+        else:
+            df_places, visitors = osgen.get_relevant_place(int(user), True)
+        if len(df_places) < k:
+            continue
+        n_yielded += 1
+        yield int(user), df_places, visitors
+
+
+def score(session, view: list, S: list) -> float:
+    """Score(S|O) with O the places of `session` within `view`"""
+    [lat1, lon1], [lat2, lon2] = view
+    window = session.df_places.iloc[
+        session.index.query_bbox(lat1, lon1, lat2, lon2)
+    ]
+    if len(window) == 0:
+        return 0.0
+
+    visitors = session.visitors.subset(window["place_id"])
+    sim_oS = np.zeros(len(window))
+    for s in set(S) & set(window["place_id"].tolist()):
+        update_sim_oS(sim_oS, s, visitors)
+    return float(calc_score_OS(window["weight"].to_numpy(), sim_oS))
+
+
+def separation(session, view: list, S: list, metric="planar"):
+    """Smallest distance between two selected places, as a multiple of the
+    distance `isos` keeps between them (0.1 of the viewport height)"""
+    if len(S) < 2:
+        return None
+    [lat1, lon1], [lat2, lon2] = view
+    places = session.df_places.set_index("place_id").loc[S]
+    distance = pairwise_distance(places["lat"], places["lon"], metric=metric)
+    np.fill_diagonal(distance, np.inf)
+    required = get_metric(metric)(lat1, lon1, lat2, lon1) * 0.1
+    return float(distance.min() / required)
+
+
+def replay(select, views: list, trace_memory=False) -> list:
+    """[(S, seconds, peak bytes or None)] of `select` over `views`, each
+    viewport continuing from the selection of the previous one"""
+    prev, D, G = [[0, 0], [1, 1]], [], []
+    steps = []
+    for view in views:
+        if trace_memory:
+            tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = perf_counter()
+            D, G = select(prev, view, D, G)
+            seconds = perf_counter() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        steps.append(([int(d) for d in D], seconds, peak))
+        prev = view
+    return steps
+
+
+def evaluate_user(
+    user, df_places, visitors, strategies: list, k: int, seed: int, memory
+) -> list:
+    session = PlaceSession(user, df_places, visitors)
+    sequences = viewport_sequences(session.df_places)
+
+    records = []
+    exact = {}
+    for name in [EXACT] + [s for s in strategies if s != EXACT]:
+        np.random.seed(seed)  # `random_selection` samples with np.random
+        select = STRATEGIES[name](session, k)
+        timed = {
+            seq: replay(select, views) for seq, views in sequences.items()
+        }
+        if memory:  # traced apart, tracing slows Python code down
+            select = STRATEGIES[name](session, k)
+            traced = {
+                seq: replay(select, views, trace_memory=True)
+                for seq, views in sequences.items()
+            }
+
+        for seq, views in sequences.items():
+            for step, (view, (S, seconds, _)) in enumerate(
+                zip(views, timed[seq])
+            ):
+                record = {
+                    "user": user,
+                    "strategy": name,
+                    "sequence": seq,
+                    "step": step,
+                    "n_selected": len(S),
+                    "seconds": seconds,
+                    "peak_bytes": traced[seq][step][2] if memory else None,
+                    "score": score(session, view, S),
+                    "separation": separation(session, view, S),
+                }
+                if name == EXACT:
+                    exact[seq, step] = (set(S), record["score"])
+                exact_S, exact_score = exact[seq, step]
+                record["score_ratio"] = (
+                    record["score"] / exact_score if exact_score > 0 else None
+                )
+                record["overlap"] = (
+                    len(exact_S & set(S)) / len(exact_S) if exact_S else None
+                )
+                if name in strategies:
+                    records.append(record)
+    return records
+
+
+def _mean(values):
+    values = [v for v in values if v is not None]
+    return float(np.mean(values)) if values else None
+
+
+def _min(values):
+    values = [v for v in values if v is not None]
+    return float(np.min(values)) if values else None
+
+
+def summarize(records: list, tolerance: float) -> dict:
+    """Per strategy aggregates, and the fastest strategy whose mean score
+    is at least (1 - `tolerance`) of the exact one while keeping selected
+    places apart as `isos` does"""
+    strategies = list(dict.fromkeys(r["strategy"] for r in records))
+    summary = {}
+    for name in strategies:
+        rows = [r for r in records if r["strategy"] == name]
+        seconds = np.array([r["seconds"] for r in rows])
+        peaks = [r["peak_bytes"] for r in rows if r["peak_bytes"] is not None]
+        summary[name] = {
+            "viewports": len(rows),
+            "score_ratio": _mean(r["score_ratio"] for r in rows),
+            "min_score_ratio": _min(r["score_ratio"] for r in rows),
+            "overlap": _mean(r["overlap"] for r in rows),
+            "min_separation": _min(r["separation"] for r in rows),
+            "seconds": float(seconds.sum()),
+            "median_seconds": float(np.median(seconds)),
+            "p95_seconds": float(np.percentile(seconds, 95)),
+            "peak_bytes": max(peaks) if peaks else None,
+        }
+
+    for name, row in summary.items():
+        row["within_tolerance"] = (
+            row["score_ratio"] is not None
+            and row["score_ratio"] >= 1 - tolerance
+            # float32 coordinates, `isos` keeps them strictly further
+            and (row["min_separation"] or 1) >= 1 - 1e-3
+        )
+    within = [name for name, row in summary.items() if row["within_tolerance"]]
+    return {
+        "tolerance": tolerance,
+        "strategies": summary,
+        "fastest_within_tolerance": min(
+            within, key=lambda name: summary[name]["seconds"], default=None
+        ),
+    }
+
+
+COLUMNS = [
+    ("strategy", "{}"),
+    ("score_ratio", "{:.3f}"),
+    ("min_score_ratio", "{:.3f}"),
+    ("overlap", "{:.2f}"),
+    ("min_separation", "{:.2f}"),
+    ("seconds", "{:.3f}"),
+    ("p95_seconds", "{:.3f}"),
+    ("peak_bytes", "{:,}"),
+    ("within_tolerance", "{}"),
+]
+
+
+def table_rows(summary: dict) -> list:
+    rows = []
+    for name, row in summary["strategies"].items():
+        row = {"strategy": name, **row}
+        rows.append(
+            [
+                "-" if row[col] is None else fmt.format(row[col])
+                for col, fmt in COLUMNS
+            ]
+        )
+    return rows
+
+
+def print_summary(summary: dict) -> None:
+    rows = [[col for col, _ in COLUMNS]] + table_rows(summary)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(COLUMNS))]
+    for row in rows:
+        print("  ".join(cell.rjust(w) for cell, w in zip(row, widths)))
+    print(f"fastest within tolerance: {summary['fastest_within_tolerance']}")
+
+
+def write_markdown(report: dict, filepath: str) -> None:
+    summary = report["summary"]
+    lines = [
+        "# Selection strategies, quality versus latency",
+        "",
+        f"Commit `{report['commit']}`, {report['timestamp']}, "
+        f"{report['platform']}.",
+        f"{report['users']} users ({report['source']}), k={report['k']}, "
+        f"seed {report['seed']}. Ratios and overlap are against "
+        f"`{EXACT}` on the same viewports; separation is the closest pair "
+        f"over the distance `isos` enforces.",
+        "",
+        "| " + " | ".join(col for col, _ in COLUMNS) + " |",
+        "|" + "---|" * len(COLUMNS),
+    ]
+    lines += ["| " + " | ".join(row) + " |" for row in table_rows(summary)]
+    lines += [
+        "",
+        f"Fastest strategy within a score tolerance of "
+        f"{summary['tolerance']:.0%}: "
+        f"**{summary['fastest_within_tolerance']}**",
+        "",
+    ]
+    with open(filepath, "w") as f:
+        f.write("\n".join(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--strategies", nargs="+", default=list(STRATEGIES), choices=STRATEGIES
+    )
+    parser.add_argument("--store", help="store to sample users from")
+    parser.add_argument("--users", type=int, default=3)
+    parser.add_argument(
+        "--places", type=int, default=10_000, help="per synthetic user"
+    )
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--tolerance", type=float, default=0.05, help="of the exact score"
+    )
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip the traced replays"
+    )
+    parser.add_argument("--output", help="JSON file to write records to")
+    parser.add_argument("--report", help="Markdown file to write summary to")
+    args = parser.parse_args()
+
+    if args.store:
+        users = store_users(args.store, args.users, args.k, args.seed)
+        source = args.store
+    else:
+        users = synthetic_users(args.users, args.places, args.seed)
+        source = f"synthetic, {args.places} places each"
+
+    records = []
+    n_users = 0
+    for user, df_places, visitors in users:
+        print(f"user {user}: {len(df_places)} places")
+        records += evaluate_user(
+            user,
+            df_places,
+            visitors,
+            args.strategies,
+            args.k,
+            args.seed,
+            not args.no_memory,
+        )
+        n_users += 1
+
+    summary = summarize(records, args.tolerance)
+    print_summary(summary)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "platform": platform.platform(),
+        "source": source,
+        "users": n_users,
+        "k": args.k,
+        "seed": args.seed,
+        "summary": summary,
+        "records": records,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.report:
+        write_markdown(report, args.report)
+
+
+if __name__ == "__main__":
+    main()
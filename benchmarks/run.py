@@ -0,0 +1,529 @@
+"""
+run.py: Repeatable benchmarks of the selection pipeline on synthetic data
+
+Every suite times its cases at each requested size on data from
+`benchmarks.synthetic` and the results are written to JSON together with the
+commit they were measured on. Sizes above the limit of a suite (greedy over
+every place is quadratic) are skipped unless --force is given.
+
+Usage:
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --suites isos maxheap --sizes 1000 100000
+    python -m benchmarks.run --compare before.json after.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import pickle
+import platform
+import subprocess
+from datetime import datetime, timezone
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+import scipy
+
+from benchmarks.bench_maxheap import run_heap
+from bitset import VisitorBitset
+from benchmarks.synthetic import generate_relevant, generate_tables
+from maxheap import Maxheap
+from metrics import (
+    METRICS,
+    distance_to_many,
+    euclidean,
+    haversine,
+    jaccard,
+    overlap_coeff,
+    pairwise_distance,
+)
+from object_selection import (
+    Approximation,
+    Deadline,
+    calc_initial_gain,
+    greedy_sos,
+    isos,
+)
+from osgenerator import OSGenerator
+from pyramid import SelectionPyramid
+from selection_state import SelectionState
+from spatial_index import SpatialIndex
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+
+def measure(fn, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = perf_counter()
+            fn()
+            times.append(perf_counter() - start)
+    return {"seconds": min(times), "median": float(np.median(times))}
+
+
+def densest_point(df_places: pd.DataFrame) -> tuple:
+    counts, lat_edges, lon_edges = np.histogram2d(
+        df_places["lat"], df_places["lon"], bins=[180, 360]
+    )
+    i, j = np.unravel_index(np.argmax(counts), counts.shape)
+    return (lat_edges[i] + lat_edges[i + 1]) / 2, (
+        lon_edges[j] + lon_edges[j + 1]
+    ) / 2
+
+
+def viewport(lat, lon, height) -> list:
+    return [[lat - height / 2, lon - height], [lat + height / 2, lon + height]]
+
+
+def bench_greedy(n, seed, repeat):
+    df_places, visitors = generate_relevant(n, seed=seed)
+    maxheap_data = [
+        df_places["place_id"].to_numpy(),
+        df_places["lat"].to_numpy(),
+        df_places["lon"].to_numpy(),
+    ]
+    height = df_places["lat"].max() - df_places["lat"].min()
+
+    approximations = {
+        "": None,
+        "+stochastic": Approximation(epsilon=0.1),
+        "+stochastic+sampled": Approximation(epsilon=0.1, sample_size=2000),
+    }
+    return {
+        f"k={k}{name}": measure(
+            lambda: greedy_sos(
+                maxheap_data,
+                df_places,
+                visitors,
+                k,
+                height * 0.1,
+                [],
+                approx=approx,
+            ),
+            repeat,
+        )
+        for k in [10, 50]
+        for name, approx in approximations.items()
+    }
+
+
+bench_greedy.max_n = 20_000
+
+
+def bench_gains(n, seed, repeat):
+    """Initial gains of every place of the densest cluster and of the whole
+    map, by chunk size and number of threads; the default chunk size is
+    "auto". Threads only help where the sparse kernels scale."""
+    df_places, visitors = generate_relevant(n, seed=seed)
+    index = SpatialIndex(df_places["lat"], df_places["lon"])
+    [lat1, lon1], [lat2, lon2] = viewport(*densest_point(df_places), 5)
+    windows = {
+        "cluster": df_places.iloc[index.query_bbox(lat1, lon1, lat2, lon2)],
+        "map": df_places,
+    }
+
+    results = {}
+    for name, df_window in windows.items():
+        window = visitors.subset(df_window["place_id"])
+        window.build_similarity_graph()
+        weights = df_window["weight"].to_numpy()
+        sim_oS = np.zeros(len(window))
+        for n_workers in [1, 2, 4]:
+            for chunk_size in [None, 128, 512, 2048]:
+                results[
+                    f"{name}+workers={n_workers}+chunk={chunk_size or 'auto'}"
+                ] = measure(
+                    lambda: calc_initial_gain(
+                        sim_oS,
+                        window.place_id,
+                        window,
+                        weights,
+                        chunk_size,
+                        n_workers,
+                    ),
+                    repeat,
+                )
+    return results
+
+
+bench_gains.max_n = 20_000
+
+
+def bench_isos(n, seed, repeat):
+    df_places, visitors = generate_relevant(n, seed=seed)
+    index = SpatialIndex(df_places["lat"], df_places["lon"])
+    lat, lon = densest_point(df_places)
+
+    heights = [40, 20, 10, 5, 2.5]
+    sequences = {
+        "zoom_in": [viewport(lat, lon, h) for h in heights],
+        "zoom_out": [viewport(lat, lon, h) for h in heights[::-1]],
+        "pan": [viewport(lat, lon + 2 * i, 5) for i in range(5)],
+    }
+
+    def run(views, state=None, pyramid=None):
+        prev, D, G = [[0, 0], [1, 1]], [], []
+        for view in views:
+            D, G = isos(
+                df_places,
+                visitors,
+                prev,
+                view,
+                10,
+                list(D),
+                list(G),
+                index=index,
+                state=state,
+                pyramid=pyramid,
+            )
+            prev = view
+
+    results = {}
+    for name, views in sequences.items():
+        results[name] = measure(lambda: run(views), repeat)
+        results[f"{name}+state"] = measure(
+            lambda: run(views, state=SelectionState()), repeat
+        )
+
+        # the app builds the tiles in the background, requests read them
+        pyramid = SelectionPyramid(10)
+        results[f"{name}+pyramid_build"] = measure(
+            lambda: [
+                pyramid.build(df_places, visitors, index, view)
+                for view in views
+            ],
+            1,
+        )
+        results[f"{name}+pyramid"] = measure(
+            lambda: run(views, pyramid=pyramid), repeat
+        )
+    return results
+
+
+bench_isos.max_n = 100_000
+
+
+def bench_deadline(n, seed, repeat):
+    """isos on first views of growing size and on the densest cluster, exact
+    against a deadline that is never reached and the default one of the app,
+    with how many of the exact selection each keeps"""
+    df_places, visitors = generate_relevant(n, seed=seed)
+    index = SpatialIndex(df_places["lat"], df_places["lon"])
+    lat = (df_places["lat"].min() + df_places["lat"].max()) / 2
+
+    def select(view, seconds):
+        deadline = None if seconds is None else Deadline(seconds)
+        with contextlib.redirect_stdout(io.StringIO()):
+            begin = perf_counter()
+            S, G = isos(
+                df_places,
+                visitors,
+                [[0, 0], [1, 1]],
+                view,
+                10,
+                index=index,
+                deadline=deadline,
+            )
+        missed = deadline is not None and deadline.missed
+        return perf_counter() - begin, S, len(S) + len(G), missed
+
+    views = {f"height={h}": viewport(lat, 0, h) for h in [10, 20, 40]}
+    views["cluster"] = viewport(*densest_point(df_places), 5)
+
+    results = {}
+    for view_name, view in views.items():
+        _, exact, _, _ = select(view, None)
+        for name, seconds in [("exact", None), ("60s", 60), ("0.5s", 0.5)]:
+            runs = [select(view, seconds) for _ in range(repeat)]
+            times = [t for t, _, _, _ in runs]
+            results[f"{view_name}+{name}"] = {
+                "seconds": min(times),
+                "median": float(np.median(times)),
+                "places": runs[0][2],
+                "missed": sum(m for _, _, _, m in runs),
+                "selected": len(exact),
+                "overlap": min(
+                    len(set(S) & set(exact)) for _, S, _, _ in runs
+                ),
+            }
+    return results
+
+
+bench_deadline.max_n = 100_000
+
+
+def bench_state(n, seed, repeat):
+    """`SelectionState.prepare` after pans of a growing share of the
+    viewport width with every place a candidate, as after a zoom in, against
+    a state starting empty, i.e. computing every gain"""
+    df_places, visitors = generate_relevant(n, seed=seed)
+    visitors.build_similarity_graph()
+    index = SpatialIndex(df_places["lat"], df_places["lon"])
+    lat = (df_places["lat"].min() + df_places["lat"].max()) / 2
+    lon, height = 0, 30
+
+    def frame(view, S):
+        [lat1, lon1], [lat2, lon2] = view
+        df_window = df_places.iloc[index.query_bbox(lat1, lon1, lat2, lon2)]
+        window = visitors.subset(df_window["place_id"])
+        window.build_similarity_graph()
+        S = [s for s in S if s in set(df_window["place_id"])]
+        candidates = df_window["place_id"][
+            ~df_window["place_id"].isin(S)
+        ].to_numpy()
+        return window, df_window["weight"].to_numpy(), S, candidates
+
+    start = viewport(lat, lon, height)
+    with contextlib.redirect_stdout(io.StringIO()):
+        D, _ = isos(
+            df_places, visitors, [[0, 0], [1, 1]], start, 10, index=index
+        )
+    primed = SelectionState()
+    primed_args = frame(start, D)
+    primed.prepare(visitors, *primed_args)
+    primed_id = primed_args[0].place_id
+
+    results = {}
+    for shift in [0.01, 0.05, 0.2, 0.5]:
+        view = viewport(lat, lon + shift * 2 * height, height)
+        args = frame(view, D)
+        n_delta = len(np.setxor1d(args[0].place_id, primed_id))
+        for name, make_state in [
+            (f"pan={shift:.0%}", lambda: pickle.loads(pickle.dumps(primed))),
+            (f"pan={shift:.0%}+empty", SelectionState),
+        ]:
+            times = []
+            for _ in range(repeat):
+                state = make_state()
+                begin = perf_counter()
+                state.prepare(visitors, *args)
+                times.append(perf_counter() - begin)
+            results[name] = {
+                "seconds": min(times),
+                "median": float(np.median(times)),
+                "places": len(args[1]),
+                "delta": int(n_delta),
+            }
+    return results
+
+
+bench_state.max_n = 100_000
+
+
+def bench_maxheap(n, seed, repeat):
+    timings = [
+        run_heap(Maxheap, n, min(1000, n // 2), seed) for _ in range(repeat)
+    ]
+    return {op: {"seconds": min(t[op] for t in timings)} for op in timings[0]}
+
+
+def bench_metrics(n, seed, repeat):
+    rng = np.random.default_rng(seed)
+    lat, lon = rng.uniform(-90, 90, n), rng.uniform(-180, 180, n)
+    df_places, visitors = generate_relevant(n, seed=seed)
+
+    results = {
+        "euclidean": measure(lambda: euclidean(0, 0, lat, lon), repeat),
+        "haversine": measure(lambda: haversine(0, 0, lat, lon), repeat),
+        **{
+            f"distance_to_many[{metric}]": measure(
+                lambda: distance_to_many(0, 0, lat, lon, metric), repeat
+            )
+            for metric in METRICS
+        },
+        **{
+            f"pairwise_distance[{metric}, 1000 x n]": measure(
+                lambda: pairwise_distance(
+                    lat[:1000], lon[:1000], lat, lon, metric
+                ),
+                repeat,
+            )
+            for metric in METRICS
+        },
+        "VisitorMatrix.jaccard": measure(
+            lambda: visitors.jaccard([0]), repeat
+        ),
+        "VisitorMatrix.jaccard_sparse": measure(
+            lambda: visitors.jaccard_sparse([0]), repeat
+        ),
+    }
+
+    # the list kernels are pure Python, time a bounded number of pairs
+    n_pairs = min(n, 100_000)
+    rows = visitors.matrix[:n_pairs]
+    seqs = np.split(rows.indices, rows.indptr[1:-1])
+    results[f"jaccard[{n_pairs} pairs]"] = measure(
+        lambda: [jaccard(seqs[0], seq) for seq in seqs], repeat
+    )
+    results[f"overlap_coeff[{n_pairs} pairs]"] = measure(
+        lambda: [overlap_coeff(seqs[0], seq) for seq in seqs], repeat
+    )
+
+    # bitsets are meant for the places of one viewport
+    n_bitset = min(n, 10_000)
+    bits = VisitorBitset.from_matrix(visitors, visitors.place_id[:n_bitset])
+    results[f"jaccard[bitset, {n_bitset} pairs]"] = measure(
+        lambda: jaccard(bits.bits[:1], bits.bits), repeat
+    )
+    results[f"overlap_coeff[bitset, {n_bitset} pairs]"] = measure(
+        lambda: overlap_coeff(bits.bits[:1], bits.bits), repeat
+    )
+    results[f"VisitorBitset.jaccard[{n_bitset}]"] = measure(
+        lambda: bits.jaccard([0]), repeat
+    )
+    return results
+
+
+def bench_osgen(n, seed, repeat):
+    tables = generate_tables(n_users=n, n_places=n, seed=seed)
+    osgen = OSGenerator()
+    results = {
+        "read_from_dataframe": measure(
+            lambda: osgen.read_from_dataframe(
+                tables["friends"],
+                tables["checkins"],
+                tables["places"],
+                tables["countries"],
+            ),
+            1,
+        )
+    }
+
+    rng = np.random.default_rng(seed)
+    users = rng.choice(osgen.friend_index.keys, 50).tolist()
+    places = rng.choice(tables["places"]["place_id"], 50).tolist()
+    queries = {
+        "get_user_friend": lambda: [osgen.get_user_friend(u) for u in users],
+        "get_user_relevant_friend": lambda: [
+            osgen.get_user_relevant_friend(u) for u in users
+        ],
+        "get_users_relevant_friend": lambda: (
+            osgen.get_users_relevant_friend(users)
+        ),
+        "get_visitor": lambda: osgen.get_visitor(places),
+        "get_user_checkin": lambda: [osgen.get_user_checkin(u) for u in users],
+        "get_user_place": lambda: [osgen.get_user_place(u) for u in users],
+        "get_relevant_place": lambda: [
+            osgen.get_relevant_place(u, True) for u in users
+        ],
+        "get_object_summary": lambda: [
+            osgen.get_object_summary(u) for u in users
+        ],
+    }
+    for name, fn in queries.items():
+        timing = measure(fn, repeat)
+        # per call, `get_visitor` and the batch method take all 50 at once
+        results[name] = {key: t / len(users) for key, t in timing.items()}
+    return results
+
+
+SUITES = {
+    "greedy": bench_greedy,
+    "gains": bench_gains,
+    "isos": bench_isos,
+    "deadline": bench_deadline,
+    "maxheap": bench_maxheap,
+    "metrics": bench_metrics,
+    "osgen": bench_osgen,
+    "state": bench_state,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(suites: list, sizes: list, seed=0, repeat=3, force=False) -> dict:
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "platform": platform.platform(),
+        "versions": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "scipy": scipy.__version__,
+        },
+        "seed": seed,
+        "repeat": repeat,
+        "results": [],
+    }
+
+    for suite in suites:
+        bench = SUITES[suite]
+        for n in sizes:
+            if n > getattr(bench, "max_n", n) and not force:
+                print(f"{suite:>8} {n:>9} skipped (above {bench.max_n})")
+                continue
+
+            for case, timing in bench(n, seed, repeat).items():
+                report["results"].append(
+                    {"suite": suite, "case": case, "n": n, **timing}
+                )
+                print(
+                    f"{suite:>8} {n:>9} {case:<32} "
+                    f"{timing['seconds'] * 1e3:>11.3f}ms"
+                )
+    return report
+
+
+def compare(baseline: dict, current: dict, threshold=1.1) -> None:
+    def keyed(report):
+        return {
+            (r["suite"], r["case"], r["n"]): r["seconds"]
+            for r in report["results"]
+        }
+
+    before, after = keyed(baseline), keyed(current)
+    print(f"{baseline['commit']} -> {current['commit']}")
+    for key in sorted(before.keys() & after.keys()):
+        ratio = after[key] / before[key] if before[key] > 0 else np.inf
+        flag = "slower" if ratio > threshold else ""
+        flag = "faster" if ratio < 1 / threshold else flag
+        print(
+            f"{key[0]:>8} {key[2]:>9} {key[1]:<32} "
+            f"{before[key] * 1e3:>11.3f}ms {after[key] * 1e3:>11.3f}ms "
+            f"{ratio:>6.2f}x {flag}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--suites", nargs="+", default=list(SUITES))
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--force", action="store_true", help="no size limit")
+    parser.add_argument("--output", help="JSON file to write results to")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="JSON"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        reports = []
+        for filepath in args.compare:
+            with open(filepath) as f:
+                reports.append(json.load(f))
+        compare(*reports)
+        return
+
+    report = run(args.suites, args.sizes, args.seed, args.repeat, args.force)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+synthetic.py: Seeded generator of Gowalla-like datasets
+
+`generate_tables` returns the four tables `OSGenerator.read_from_dataframe`
+expects (friends, checkins, places, countries), `write_csv` stores them as
+the CSVs of `data/`. `generate_relevant` directly produces the relevant
+places of one user with their visitors, the input of `isos` and
+`greedy_sos`, at sizes no real user reaches.
+
+`skew` is the exponent of the Zipf-like popularity of users (friends and
+checkins), places (checkins) and place clusters (locations); 0 is uniform.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from visitor_matrix import VisitorMatrix
+
+
+def zipf_choice(rng, n: int, size: int, skew: float) -> np.ndarray:
+    """`size` draws from range(n), item of popularity rank r having a
+    probability proportional to 1 / r^skew. Ranks are shuffled so popular
+    items are not the smallest ids."""
+    p = 1.0 / np.arange(1, n + 1) ** skew
+    rank_to_item = rng.permutation(n)
+    return rank_to_item[rng.choice(n, size, p=p / p.sum())]
+
+
+def generate_locations(rng, n: int, n_clusters: int, skew: float):
+    """Places scattered around cities, returns (lat, lon, cluster)"""
+    center_lat = rng.uniform(-50, 65, n_clusters)
+    center_lon = rng.uniform(-180, 180, n_clusters)
+    spread = rng.uniform(0.05, 1.0, n_clusters)
+
+    cluster = zipf_choice(rng, n_clusters, n, skew)
+    lat = center_lat[cluster] + rng.normal(0, 1, n) * spread[cluster]
+    lon = center_lon[cluster] + rng.normal(0, 1, n) * spread[cluster]
+    return np.clip(lat, -89.9, 89.9), (lon + 180) % 360 - 180, cluster
+
+
+def generate_tables(
+    n_users: int,
+    n_places: int,
+    checkins_per_user: float = 10,
+    friends_per_user: float = 10,
+    n_countries: int = 50,
+    n_clusters: int = 200,
+    skew: float = 1.0,
+    seed: int = 0,
+) -> dict:
+    rng = np.random.default_rng(seed)
+
+    df_countries = pd.DataFrame(
+        {
+            "country_id": np.arange(n_countries),
+            "name": [f"Country {i}" for i in range(n_countries)],
+        }
+    )
+
+    place_id = np.sort(rng.choice(10 * n_places, n_places, replace=False))
+    lat, lon, cluster = generate_locations(rng, n_places, n_clusters, skew)
+    df_places = pd.DataFrame(
+        {
+            "place_id": place_id,
+            "lat": lat,
+            "lon": lon,
+            "country_id": cluster % n_countries,
+        }
+    )
+
+    # undirected friendships, listed in both directions like Gowalla
+    n_edges = int(n_users * friends_per_user / 2)
+    edges = np.stack(
+        [
+            zipf_choice(rng, n_users, n_edges, skew),
+            rng.integers(0, n_users, n_edges),
+        ],
+        axis=1,
+    )
+    edges = edges[edges[:, 0] != edges[:, 1]]
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    edges = np.concatenate([edges, edges[:, ::-1]])
+    edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+    df_friends = pd.DataFrame(edges, columns=["user_id", "friend_id"])
+
+    n_checkins = int(n_users * checkins_per_user)
+    user_id = zipf_choice(rng, n_users, n_checkins, skew)
+    timestamp = rng.integers(1.23e9, 1.29e9, n_checkins)  # Feb 09 - Nov 10
+    order = np.lexsort((timestamp, user_id))
+    df_checkins = pd.DataFrame(
+        {
+            "user_id": user_id[order],
+            "place_id": place_id[zipf_choice(rng, n_places, n_checkins, skew)],
+            "datetime": pd.to_datetime(timestamp[order], unit="s"),
+        }
+    )
+
+    return {
+        "friends": df_friends,
+        "checkins": df_checkins,
+        "places": df_places,
+        "countries": df_countries,
+    }
+
+
+def write_csv(tables: dict, data_dir: str) -> None:
+    os.makedirs(data_dir, exist_ok=True)
+    for name, df in tables.items():
+        if name == "checkins":
+            df = df.assign(
+                datetime=df["datetime"].dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+            )
+        df.to_csv(os.path.join(data_dir, f"{name}.csv"), index=False)
+
+
+def generate_relevant(
+    n_places: int,
+    n_users: int = None,
+    visitors_per_place: float = 5,
+    n_clusters: int = 200,
+    skew: float = 1.0,
+    seed: int = 0,
+):
+    """Returns (df_places, VisitorMatrix) shaped like the output of
+    `OSGenerator.get_relevant_place(user, True)`"""
+    rng = np.random.default_rng(seed)
+    if n_users is None:
+        n_users = max(10, n_places // 2)
+
+    place_id = np.sort(rng.choice(10 * n_places, n_places, replace=False))
+    lat, lon, cluster = generate_locations(rng, n_places, n_clusters, skew)
+
+    # visitors of a place are mostly drawn among the users of its cluster
+    n_visitor = 1 + rng.poisson(visitors_per_place - 1, n_places)
+    indptr = np.concatenate([[0], np.cumsum(n_visitor)])
+    local_user = zipf_choice(rng, n_users, indptr[-1], skew)
+    is_local = rng.random(indptr[-1]) < 0.8
+    user_id = np.where(
+        is_local,
+        (np.repeat(cluster, n_visitor) * 7919 + local_user % 50) % n_users,
+        local_user,
+    )
+
+    visitors = VisitorMatrix(place_id, indptr, user_id)
+    n_unique = visitors.sizes.astype(np.float32)
+    df_places = pd.DataFrame(
+        {
+            "place_id": place_id,
+            "lat": lat,
+            "lon": lon,
+            "country_id": cluster % 50,
+            "is_direct": (rng.random(n_places) < 0.1).astype(int),
+            "weight": n_unique / (n_unique + 10),
+        }
+    )
+    return df_places, visitors
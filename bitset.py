@@ -0,0 +1,130 @@
+"""
+bitset.py: Packed bitsets of place visitors
+
+The visitors of a place become one row of uint64 words over a compact index
+of the users visiting a given set of places (a few thousand for a viewport),
+so the intersection and union sizes of a whole block of places come from
+vectorized AND/OR and popcount. `metrics.jaccard` and
+`metrics.overlap_coeff` accept such rows besides visitor lists.
+"""
+
+import numpy as np
+
+from visitor_matrix import VisitorMatrix
+
+_POPCOUNT_LUT = np.array([bin(i).count("1") for i in range(256)], np.uint8)
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """Number of set bits of every uint64 word"""
+    if hasattr(np, "bitwise_count"):  # NumPy >= 2.0
+        return np.bitwise_count(words)
+
+    words = np.ascontiguousarray(words, dtype=np.uint64)
+    per_byte = _POPCOUNT_LUT[words.view(np.uint8)]
+    return per_byte.reshape(words.shape + (8,)).sum(-1, dtype=np.uint8)
+
+
+def count_bits(bits: np.ndarray) -> np.ndarray:
+    """Number of set bits of every bitset, i.e. along the last axis"""
+    return popcount(bits).sum(-1, dtype=np.int64)
+
+
+def is_bitset(seq) -> bool:
+    return isinstance(seq, np.ndarray) and seq.dtype == np.uint64
+
+
+def pack(indptr, indices, n_bits: int) -> np.ndarray:
+    """(len(indptr) - 1, n_words) bitsets, row i having the bits
+    `indices[indptr[i]:indptr[i + 1]]` set"""
+    indptr = np.asarray(indptr, dtype=np.int64)
+    indices = np.asarray(indices, dtype=np.uint64)
+
+    bits = np.zeros((len(indptr) - 1, max(1, -(-n_bits // 64))), np.uint64)
+    row = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    np.bitwise_or.at(
+        bits,
+        (row, (indices >> np.uint64(6)).astype(np.int64)),
+        np.left_shift(np.uint64(1), indices & np.uint64(63)),
+    )
+    return bits
+
+
+class VisitorBitset:
+    """Bitset counterpart of `VisitorMatrix` for the rows it is built from,
+    offering the same `rows` and `jaccard` lookups"""
+
+    def __init__(self, place_id, bits, user_id):
+        self.place_id = np.asarray(place_id, dtype=np.int64)
+        self.bits = bits
+        self.user_id = user_id  # user of every bit
+        self.sizes = count_bits(bits)
+
+        self._sort_idx = np.argsort(self.place_id, kind="stable")
+        self._sorted_id = self.place_id[self._sort_idx]
+
+    @classmethod
+    def from_matrix(cls, visitors: VisitorMatrix, place_ids=None):
+        """Packs the rows of `place_ids` (all rows by default) over the
+        users visiting them"""
+        if place_ids is not None:
+            visitors = visitors.subset(place_ids)
+
+        matrix = visitors.matrix
+        used = np.unique(matrix.indices)
+        bits = pack(
+            matrix.indptr, np.searchsorted(used, matrix.indices), len(used)
+        )
+        return cls(visitors.place_id, bits, visitors.user_id[used])
+
+    @classmethod
+    def from_dict(cls, d_visitor: dict):
+        return cls.from_matrix(VisitorMatrix.from_dict(d_visitor))
+
+    def __len__(self):
+        return len(self.place_id)
+
+    def __repr__(self):
+        return (
+            f"VisitorBitset({len(self)} places, {len(self.user_id)} users, "
+            f"{self.bits.shape[1]} words per place)"
+        )
+
+    def rows(self, place_ids) -> np.ndarray:
+        place_ids = np.atleast_1d(np.asarray(place_ids, dtype=np.int64))
+        pos = np.searchsorted(self._sorted_id, place_ids)
+        pos = np.minimum(pos, len(self._sorted_id) - 1)
+
+        is_exist = self._sorted_id[pos] == place_ids
+        if not np.all(is_exist):
+            failed_idx = np.argmin(is_exist)
+            raise KeyError(f"Place {place_ids[failed_idx]} doesn't exist")
+
+        return self._sort_idx[pos]
+
+    def _intersect(self, rows, chunk_size=2**22) -> np.ndarray:
+        """Intersection sizes of `rows` against every row"""
+        rows = np.atleast_1d(rows)
+        n_intersect = np.empty((len(rows), len(self)), dtype=np.int64)
+
+        block = max(1, chunk_size // max(1, self.bits.size))
+        for start in range(0, len(rows), block):
+            sub = self.bits[rows[start : start + block]]
+            n_intersect[start : start + block] = count_bits(
+                sub[:, None, :] & self.bits[None, :, :]
+            )
+        return n_intersect
+
+    def jaccard(self, rows) -> np.ndarray:
+        """Jaccard similarity of `rows` against every row, (len(rows), n)"""
+        rows = np.atleast_1d(rows)
+        n_intersect = self._intersect(rows)
+        n_union = self.sizes[rows][:, None] + self.sizes[None, :] - n_intersect
+        return n_intersect / n_union
+
+    def overlap_coeff(self, rows) -> np.ndarray:
+        """Overlap coefficient of `rows` against every row"""
+        rows = np.atleast_1d(rows)
+        n_intersect = self._intersect(rows)
+        n_min = np.minimum(self.sizes[rows][:, None], self.sizes[None, :])
+        return n_intersect / n_min
@@ -0,0 +1,73 @@
+"""
+csr_index.py: Offset-indexed adjacency arrays (CSR) over a key column
+
+`values[indptr[i]:indptr[i + 1]]` holds the values of `keys[i]`. Without
+explicit values, the values are the row positions of each key, which turns
+a lookup into a slice instead of a scan over the whole table.
+"""
+
+import numpy as np
+
+
+class CSRIndex:
+    def __init__(self, keys, values=None, unique=False):
+        keys = np.asarray(keys)
+        if values is None:
+            order = np.argsort(keys, kind="stable")
+            values = order
+        else:
+            values = np.asarray(values)
+            order = np.lexsort((values, keys))
+            values = values[order]
+        keys = keys[order]
+
+        if unique and len(keys) > 0:
+            is_new = np.ones(len(keys), dtype=bool)
+            is_new[1:] = (keys[1:] != keys[:-1]) | (values[1:] != values[:-1])
+            keys, values = keys[is_new], values[is_new]
+
+        self.keys, start = np.unique(keys, return_index=True)
+        self.indptr = np.append(start, len(keys)).astype(np.int64)
+        self.values = values
+
+    @classmethod
+    def from_arrays(cls, keys, indptr, values):
+        index = cls.__new__(cls)
+        index.keys, index.indptr, index.values = keys, indptr, values
+        return index
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, keys):
+        """Returns the position of every key in `self.keys` and whether it
+        exists"""
+        keys = np.atleast_1d(np.asarray(keys))
+        idx = np.searchsorted(self.keys, keys)
+        idx = np.minimum(idx, max(len(self.keys) - 1, 0))
+        if len(self.keys) == 0:
+            return idx, np.zeros(len(keys), dtype=bool)
+        return idx, self.keys[idx] == keys
+
+    def contains(self, keys) -> np.ndarray:
+        return self.find(keys)[1]
+
+    def degree(self, keys) -> np.ndarray:
+        idx, is_found = self.find(keys)
+        return np.where(is_found, self.indptr[idx + 1] - self.indptr[idx], 0)
+
+    def get(self, key) -> np.ndarray:
+        idx, is_found = self.find(key)
+        if not is_found[0]:
+            return self.values[:0]
+        return self.values[self.indptr[idx[0]] : self.indptr[idx[0] + 1]]
+
+    def get_many(self, keys) -> np.ndarray:
+        """Concatenated values of `keys`, missing keys contribute nothing"""
+        idx, is_found = self.find(keys)
+        idx = idx[is_found]
+        start, stop = self.indptr[idx], self.indptr[idx + 1]
+
+        n = stop - start
+        offset = np.repeat(start - np.cumsum(n) + n, n)
+        return self.values[offset + np.arange(np.sum(n))]
@@ -0,0 +1,234 @@
+"""
+datastore.py: Typed binary cache of the CSV datasets
+
+Every table is read with `ingest.read_tables` (compact dtypes, sorted by
+lookup key, unvisited places dropped) and written once as a directory of
+`.npy` column files. Opening the store
+memory-maps the columns, so no parsing happens at startup and pages are
+only read when touched. `manifest.json` records the MD5 of each source CSV;
+a store whose sources changed is rebuilt.
+
+The indexes of `OSGenerator` are saved next to the tables (`index/`), so
+processes opening the store share one read-only copy of tables and indexes
+through the page cache, and attach in milliseconds instead of rebuilding
+them. `publish_store` copies a store to shared memory (/dev/shm) for
+deployments whose workers should never touch the disk.
+
+Usage: python datastore.py [data_dir] [store_dir] [--publish DIR]
+"""
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from ingest import TABLES, read_tables
+
+STORE_VERSION = 2  # 2: epoch timestamps, presorted tables
+SHM_DIR = "/dev/shm"
+
+
+def md5sum(filepath: str, chunk_size: int = 2**20) -> str:
+    md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def read_manifest(store_dir: str) -> dict:
+    filepath = os.path.join(store_dir, "manifest.json")
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath) as f:
+        return json.load(f)
+
+
+def store_version(store_dir: str) -> str:
+    """Hash of the store format and the MD5 of its sources, which changes
+    whenever anything derived from the dataset may"""
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No dataset store in {store_dir}")
+
+    sources = sorted(
+        (name, source["md5"]) for name, source in manifest["sources"].items()
+    )
+    version = json.dumps([manifest["version"], sources])
+    return hashlib.md5(version.encode()).hexdigest()
+
+
+def file_stat(filepath: str) -> dict:
+    stat = os.stat(filepath)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def is_store_current(store_dir: str, csv_paths: dict) -> bool:
+    manifest = read_manifest(store_dir)
+    if manifest is None or manifest.get("version") != STORE_VERSION:
+        return False
+
+    for name, path in csv_paths.items():
+        source = manifest["sources"].get(name, {})
+        # hashing GBs of CSV on every worker start is what the stat avoids
+        stat = file_stat(path)
+        if all(source.get(key) == value for key, value in stat.items()):
+            continue
+        if source.get("md5") != md5sum(path):
+            return False
+    return True
+
+
+def update_store(csv_paths: dict, store_dir: str) -> dict:
+    """Builds `store_dir` unless it is current, once for processes starting
+    together: the others wait on the lock file next to the store, then find
+    it current. Returns the manifest of the new store, None if current."""
+    lock_path = store_dir.rstrip(os.sep) + ".lock"
+    os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+    with open(lock_path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if is_store_current(store_dir, csv_paths):
+            return None
+        return build_store(csv_paths, store_dir)
+
+
+def build_store(csv_paths: dict, store_dir: str) -> dict:
+    """Converts the CSVs in `csv_paths` ({table: path}) into `store_dir`"""
+    tmp_dir = store_dir.rstrip(os.sep) + f".tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    manifest = {"version": STORE_VERSION, "sources": {}, "tables": {}}
+    tables, _ = read_tables(csv_paths)
+    for name, path in csv_paths.items():
+        df = tables.pop(name)
+
+        os.makedirs(os.path.join(tmp_dir, name))
+        dtypes = {}
+        for i, col in enumerate(df.columns):
+            values = df[col].to_numpy()
+            if values.dtype == object:  # categorical names
+                values = values.astype(np.str_)
+            np.save(os.path.join(tmp_dir, name, f"{i}.npy"), values)
+            dtypes[col] = str(values.dtype)
+
+        manifest["sources"][name] = {
+            "path": path,
+            "md5": md5sum(path),
+            **file_stat(path),
+        }
+        manifest["tables"][name] = {"n_rows": len(df), "columns": dtypes}
+        del df
+
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    # swap the finished store in so readers never see a partial one
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.rename(tmp_dir, store_dir)
+    return manifest
+
+
+def open_store(store_dir: str) -> dict:
+    """Memory-maps every table of the store as a read-only DataFrame"""
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No dataset store in {store_dir}")
+
+    tables = {}
+    for name, table in manifest["tables"].items():
+        columns = {
+            col: np.load(
+                os.path.join(store_dir, name, f"{i}.npy"), mmap_mode="r"
+            )
+            for i, col in enumerate(table["columns"])
+        }
+        # copy=False keeps one block per column, i.e. views of the memmaps
+        tables[name] = pd.DataFrame(columns, copy=False)
+
+    return tables
+
+
+def save_arrays(array_dir: str, arrays: dict) -> None:
+    """Writes {name: array} as `<array_dir>/<name>.npy`, moving the whole
+    directory in at once. Keeps the arrays of a process that was faster."""
+    tmp_dir = array_dir.rstrip(os.sep) + f".tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), values)
+
+    try:
+        os.rename(tmp_dir, array_dir)
+    except OSError:  # `array_dir` exists already
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_arrays(array_dir: str) -> dict:
+    """Memory-maps the arrays of `save_arrays`, None when there are none"""
+    if not os.path.isdir(array_dir):
+        return None
+    return {
+        filename[: -len(".npy")]: np.load(
+            os.path.join(array_dir, filename), mmap_mode="r"
+        )
+        for filename in sorted(os.listdir(array_dir))
+        if filename.endswith(".npy")
+    }
+
+
+def publish_store(store_dir: str, target_dir: str = None) -> str:
+    """Copies the store to `target_dir`, by default a directory in shared
+    memory named after the store, and returns the path workers should open"""
+    if read_manifest(store_dir) is None:
+        raise FileNotFoundError(f"No dataset store in {store_dir}")
+    if target_dir is None:
+        name = os.path.basename(os.path.abspath(store_dir))
+        target_dir = os.path.join(SHM_DIR, f"sos-{name}")
+
+    tmp_dir = target_dir.rstrip(os.sep) + f".tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.copytree(store_dir, tmp_dir)
+    shutil.rmtree(target_dir, ignore_errors=True)
+    os.rename(tmp_dir, target_dir)
+    return target_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("data_dir", nargs="?", default="data")
+    parser.add_argument("store_dir", nargs="?", default="data/store")
+    parser.add_argument(
+        "--publish",
+        nargs="?",
+        const="",
+        metavar="DIR",
+        help=f"copy the store with its indexes to DIR (in {SHM_DIR})",
+    )
+    args = parser.parse_args()
+
+    csv_paths = {
+        name: os.path.join(args.data_dir, f"{name}.csv") for name in TABLES
+    }
+    manifest = update_store(csv_paths, args.store_dir)
+    if manifest is None:
+        print(f"{args.store_dir} is up to date")
+    else:
+        for name, table in manifest["tables"].items():
+            print(f"{name}: {table['n_rows']} rows {table['columns']}")
+
+    if args.publish is not None:
+        from osgenerator import OSGenerator  # builds and saves the indexes
+
+        OSGenerator().read_from_store(args.store_dir)
+        target_dir = publish_store(args.store_dir, args.publish or None)
+        print(f"published to {target_dir}, set SOS_STORE_DIR={target_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+geojson_layer.py: Selected places as a single dl.GeoJSON layer
+
+The places go to the browser as one FeatureCollection, optionally geobuf
+encoded, carrying only their id, whether they are direct and whether they
+were selected. Markers and tooltips are made client-side by the functions in
+`assets/geojson_layer.js`, styled from the `hideout` of the layer, so the
+payload and the render time no longer grow with Dash components per place.
+"""
+
+import dash_leaflet as dl
+import dash_leaflet.express as dlx
+import numpy as np
+import pandas as pd
+
+MAX_CONTEXT = 5000  # unselected places shown at most
+
+STYLE = {
+    "selected": {"radius": 7, "color": "#2a6ebb", "weight": 2},
+    "context": {"radius": 3, "color": "#888888", "weight": 0},
+    "direct_opacity": 1,
+    "indirect_opacity": 0.5,
+}
+
+
+def to_geojson(df_places: pd.DataFrame, is_selected) -> dict:
+    """FeatureCollection of the points of `df_places`, with the properties
+    the client-side functions read"""
+    coordinates = np.round(
+        np.stack([df_places["lon"], df_places["lat"]], axis=1).astype(float),
+        5,
+    ).tolist()
+    properties = zip(
+        df_places["place_id"].tolist(),
+        df_places["is_direct"].tolist(),
+        np.asarray(is_selected, dtype=int).tolist(),
+    )
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": xy},
+                "properties": {"id": pid, "direct": direct, "sel": sel},
+            }
+            for xy, (pid, direct, sel) in zip(coordinates, properties)
+        ],
+    }
+
+
+def selection_layer(
+    df_places: pd.DataFrame,
+    selected: list,
+    unselected: list = None,
+    geobuf: bool = True,
+    layer_id: str = "selection-geojson",
+) -> dl.GeoJSON:
+    """Layer of the `selected` places and, when given, up to `MAX_CONTEXT`
+    of the `unselected` ones drawn beneath them"""
+    is_selected = df_places["place_id"].isin(selected).to_numpy()
+    is_shown = is_selected.copy()
+    if unselected is not None and len(unselected) > 0:
+        context_pos = np.flatnonzero(
+            df_places["place_id"].isin(unselected).to_numpy() & ~is_selected
+        )
+        if len(context_pos) > MAX_CONTEXT:  # evenly spread, reproducible
+            context_pos = context_pos[
+                np.linspace(0, len(context_pos) - 1, MAX_CONTEXT).astype(int)
+            ]
+        is_shown[context_pos] = True
+
+    # context first, so selected markers are drawn on top
+    order = np.flatnonzero(is_shown)
+    order = order[np.argsort(is_selected[order], kind="stable")]
+    geojson = to_geojson(df_places.iloc[order], is_selected[order])
+
+    return dl.GeoJSON(
+        id=layer_id,
+        data=dlx.geojson_to_geobuf(geojson) if geobuf else geojson,
+        format="geobuf" if geobuf else "geojson",
+        options={"pointToLayer": {"variable": "sosLayers.pointToLayer"}},
+        hideout=STYLE,
+    )
@@ -0,0 +1,202 @@
+"""
+ingest.py: Memory-lean loading of the CSV datasets
+
+Each CSV is streamed in chunks of `chunk_rows` rows and every chunk is
+converted to compact column arrays right away, so pandas' default int64,
+float64 and object columns never exist for a whole table:
+    ids          int32 (int64 when they do not fit)
+    coordinates  float32
+    timestamps   int64 seconds since the epoch
+    names        categorical
+Tables are optionally sorted by their lookup key, and places nobody checked
+in are dropped, since nothing in the app can reach them.
+
+Usage: python ingest.py [data_dir] [--naive]
+"""
+
+import argparse
+import os
+import resource
+import sys
+
+import numpy as np
+import pandas as pd
+
+TABLES = ["friends", "checkins", "places", "countries"]
+
+# column -> dtype, "epoch" or "category"; other columns go through downcast
+SCHEMA = {
+    "friends": {"user_id": "id", "friend_id": "id"},
+    "checkins": {"user_id": "id", "place_id": "id", "datetime": "epoch"},
+    "places": {
+        "place_id": "id",
+        "lat": np.float32,
+        "lon": np.float32,
+        "country_id": "id",
+    },
+    "countries": {"country_id": "id", "name": "category"},
+}
+
+# column the OSGenerator indexes look each table up by
+SORT_KEYS = {
+    "friends": "user_id",
+    "checkins": "user_id",
+    "places": "place_id",
+    "countries": "country_id",
+}
+
+
+def downcast(column: pd.Series) -> np.ndarray:
+    values = column.to_numpy()
+
+    if np.issubdtype(values.dtype, np.integer):
+        info = np.iinfo(np.int32)
+        if len(values) == 0 or (
+            values.min() >= info.min and values.max() <= info.max
+        ):
+            return values.astype(np.int32)
+        return values.astype(np.int64)
+
+    if np.issubdtype(values.dtype, np.floating):
+        return values.astype(np.float32)
+
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype("datetime64[ns]")
+
+    # text columns, parsed as timestamps when they look like ones
+    try:
+        timestamp = pd.to_datetime(column, utc=True).dt.tz_convert(None)
+        return timestamp.to_numpy().astype("datetime64[ns]")
+    except (ValueError, TypeError, OverflowError):
+        return column.astype(str).to_numpy().astype(np.str_)
+
+
+def to_epoch(column: pd.Series) -> np.ndarray:
+    timestamp = pd.to_datetime(column, utc=True).dt.tz_convert(None)
+    return timestamp.to_numpy().astype("datetime64[s]").astype(np.int64)
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process, in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def read_table(
+    name: str, path: str, chunk_rows: int = 2**20, presort: bool = True
+) -> pd.DataFrame:
+    schema = SCHEMA.get(name, {})
+    chunks = {}
+
+    for df_chunk in pd.read_csv(path, chunksize=chunk_rows):
+        for col in df_chunk.columns:
+            kind = schema.get(col)
+            if kind == "id":
+                values = downcast(df_chunk[col])
+            elif kind == "epoch":
+                values = to_epoch(df_chunk[col])
+            elif kind is None or kind == "category":
+                values = df_chunk[col].to_numpy()
+            else:
+                values = df_chunk[col].to_numpy().astype(kind)
+            chunks.setdefault(col, []).append(values)
+        del df_chunk
+
+    columns = {}
+    for col, values in chunks.items():
+        values = np.concatenate(values)  # int32 chunks promote if needed
+        kind = schema.get(col)
+        if kind == "category":
+            columns[col] = pd.Categorical(values)
+        elif kind is None:
+            columns[col] = downcast(pd.Series(values))
+        else:
+            columns[col] = values
+    chunks.clear()
+
+    df = pd.DataFrame(columns, copy=False)
+    if presort and name in SORT_KEYS and len(df) > 0:
+        key = df[SORT_KEYS[name]].to_numpy()
+        if np.any(key[1:] < key[:-1]):
+            df = df.iloc[np.argsort(key, kind="stable")].reset_index(drop=True)
+    return df
+
+
+def read_tables(
+    csv_paths: dict,
+    chunk_rows: int = 2**20,
+    presort: bool = True,
+    drop_unused: bool = True,
+) -> tuple:
+    """Reads the CSVs of `csv_paths` ({table: path}). Returns the tables and
+    a report of their sizes, dropped rows and peak RSS before and after."""
+    report = {"peak_rss_before": peak_rss(), "tables": {}}
+
+    tables = {}
+    for name, path in csv_paths.items():
+        tables[name] = read_table(name, path, chunk_rows, presort)
+        report["tables"][name] = {"n_rows": len(tables[name]), "n_dropped": 0}
+
+    if drop_unused and "places" in tables and "checkins" in tables:
+        df_places = tables["places"]
+        is_visited = np.isin(
+            df_places["place_id"].to_numpy(),
+            tables["checkins"]["place_id"].to_numpy(),
+        )
+        if not np.all(is_visited):
+            tables["places"] = df_places[is_visited].reset_index(drop=True)
+            report["tables"]["places"]["n_rows"] = int(np.sum(is_visited))
+            report["tables"]["places"]["n_dropped"] = int(np.sum(~is_visited))
+
+    for name, df in tables.items():
+        report["tables"][name]["bytes"] = int(
+            df.memory_usage(index=False, deep=True).sum()
+        )
+    report["peak_rss_after"] = peak_rss()
+    return tables, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("data_dir", nargs="?", default="data")
+    parser.add_argument(
+        "--naive", action="store_true", help="plain pd.read_csv instead"
+    )
+    args = parser.parse_args()
+
+    csv_paths = {
+        name: os.path.join(args.data_dir, f"{name}.csv") for name in TABLES
+    }
+    if args.naive:
+        before = peak_rss()
+        tables = {name: pd.read_csv(path) for name, path in csv_paths.items()}
+        report = {
+            "peak_rss_before": before,
+            "tables": {
+                name: {
+                    "n_rows": len(df),
+                    "n_dropped": 0,
+                    "bytes": int(
+                        df.memory_usage(index=False, deep=True).sum()
+                    ),
+                }
+                for name, df in tables.items()
+            },
+            "peak_rss_after": peak_rss(),
+        }
+    else:
+        tables, report = read_tables(csv_paths)
+
+    for name, table in report["tables"].items():
+        print(
+            f"{name:>10}: {table['n_rows']:>10} rows "
+            f"({table['n_dropped']} dropped) {table['bytes'] / 2**20:>9.1f} MB"
+        )
+    print(
+        f"peak RSS {report['peak_rss_before'] / 2**20:.1f} MB before, "
+        f"{report['peak_rss_after'] / 2**20:.1f} MB after"
+    )
+
+
+if __name__ == "__main__":
+    main()
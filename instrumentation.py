@@ -0,0 +1,278 @@
+"""
+instrumentation.py: Spans and counters for the selection pipeline
+
+    with instrumentation.request("display_os_on_map"):
+        with instrumentation.span("isos.pruning"):
+            ...
+        instrumentation.count("isos.pruned", n_pruned)
+
+Spans and counters are summed per request, and every request adds its
+totals to in-process histograms (milliseconds for spans, counts for
+counters). `register_routes` serves them as JSON from the Flask server
+behind Dash. Requests of background callbacks run in other processes, so
+after `share(cache)` their records go through a bounded diskcache next to
+the shared one and are collected by `snapshot`. When disabled, `span`
+returns a shared no-op context manager and `count` returns at once.
+
+Enabled with `enable()` or the environment variables
+    SOS_INSTRUMENT=1          collect spans and counters
+    SOS_PROFILE_DIR=<dir>     also write a cProfile dump of every request
+"""
+
+import bisect
+import cProfile
+import contextlib
+import functools
+import os
+import threading
+from collections import deque
+from time import perf_counter
+
+SPAN_BOUNDS = [0.01 * 2**i for i in range(24)]  # ms, 10us to ~84s
+COUNT_BOUNDS = [2**i for i in range(31)]
+
+_enabled = os.environ.get("SOS_INSTRUMENT", "0") not in ("", "0")
+_profile_dir = os.environ.get("SOS_PROFILE_DIR") or None
+_null_span = contextlib.nullcontext()
+_lock = threading.Lock()
+_local = threading.local()
+_histograms = {}
+_recent = deque(maxlen=100)
+_n_requests = 0
+_store = None  # diskcache.Cache shared with background processes
+_store_prefix = "instrumentation"
+_store_expire = None
+
+
+class Histogram:
+    """Counts of values per bucket, bucket i holding values up to
+    `bounds[i]` and the last one everything above"""
+
+    def __init__(self, bounds: list):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def add(self, value: float) -> None:
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile"""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds + [self.max], self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min if self.count else 0.0,
+            "max": self.max if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": [
+                [bound, n]
+                for bound, n in zip(self.bounds + ["inf"], self.buckets)
+                if n > 0
+            ],
+        }
+
+
+def enable(flag: bool = True, profile_dir: str = None) -> None:
+    global _enabled, _profile_dir
+    _enabled = flag
+    _profile_dir = profile_dir
+
+
+def share(
+    cache,
+    prefix: str = "instrumentation",
+    size_limit: int = 2**24,
+    expire: float = 3600,
+) -> None:
+    """Sends the records of requests to the queue `prefix` of a diskcache
+    next to `cache` (a diskcache.Cache), where `snapshot` in any process
+    collects them. The queue has a cache of its own, so records nobody
+    collects expire after `expire` seconds and never take more than
+    `size_limit` bytes, instead of crowding the sessions out of `cache`."""
+    import diskcache
+
+    global _store, _store_prefix, _store_expire
+    _store = diskcache.Cache(
+        os.path.join(cache.directory, prefix), size_limit=size_limit
+    )
+    _store_prefix = prefix
+    _store_expire = expire
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    global _n_requests
+    with _lock:
+        _histograms.clear()
+        _recent.clear()
+        _n_requests = 0
+
+
+class _Span:
+    __slots__ = ["name", "start"]
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = 1e3 * (perf_counter() - self.start)
+        record = getattr(_local, "record", None)
+        if record is None:
+            _observe(f"span.{self.name}", elapsed, SPAN_BOUNDS)
+        else:
+            spans = record["spans"]
+            spans[self.name] = spans.get(self.name, 0.0) + elapsed
+        return False
+
+
+def span(name: str):
+    if not _enabled:
+        return _null_span
+    return _Span(name)
+
+
+def count(name: str, n: int = 1) -> None:
+    if not _enabled:
+        return
+    record = getattr(_local, "record", None)
+    if record is None:
+        _observe(f"count.{name}", int(n), COUNT_BOUNDS)
+    else:
+        counters = record["counters"]
+        counters[name] = counters.get(name, 0) + int(n)
+
+
+def timed(name: str):
+    """Decorator recording every call of a function as span `name`"""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def request(name: str):
+    """Groups the spans and counters of one request. Nested requests are
+    folded into the outer one."""
+    if not _enabled or getattr(_local, "record", None) is not None:
+        yield
+        return
+
+    record = {"request": name, "spans": {}, "counters": {}}
+    _local.record = record
+
+    profiler = None
+    if _profile_dir is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record["spans"][name] = 1e3 * (perf_counter() - start)
+        _local.record = None
+
+        if _store is not None:
+            _store.push(record, prefix=_store_prefix, expire=_store_expire)
+            n_request = os.getpid()  # a process per background job
+        else:
+            n_request = _add(record)
+
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(_profile_dir, exist_ok=True)
+            profiler.dump_stats(
+                os.path.join(_profile_dir, f"{name}-{n_request}.prof")
+            )
+
+
+def _add(record: dict) -> int:
+    global _n_requests
+    with _lock:
+        _n_requests += 1
+        for key, value in record["spans"].items():
+            _observe(f"span.{key}", value, SPAN_BOUNDS, locked=True)
+        for key, value in record["counters"].items():
+            _observe(f"count.{key}", value, COUNT_BOUNDS, locked=True)
+        _recent.append(record)
+        return _n_requests
+
+
+def _collect() -> None:
+    """Adds the records other processes pushed to the shared cache"""
+    if _store is None:
+        return
+    while True:
+        _, record = _store.pull(prefix=_store_prefix)
+        if record is None:
+            return
+        _add(record)
+
+
+def _observe(key, value, bounds, locked=False) -> None:
+    with _lock if not locked else contextlib.nullcontext():
+        if key not in _histograms:
+            _histograms[key] = Histogram(bounds)
+        _histograms[key].add(value)
+
+
+def snapshot() -> dict:
+    _collect()
+    with _lock:
+        return {
+            "enabled": _enabled,
+            "profile_dir": _profile_dir,
+            "n_requests": _n_requests,
+            "histograms": {
+                key: hist.to_dict()
+                for key, hist in sorted(_histograms.items())
+            },
+            "recent": list(_recent),
+        }
+
+
+def register_routes(server, path: str = "/_instrumentation") -> None:
+    """Serves `snapshot()` from the Flask `server`, `?reset=1` clears it"""
+    from flask import jsonify, request as flask_request
+
+    def instrumentation_view():
+        report = snapshot()
+        if flask_request.args.get("reset"):
+            reset()
+        return jsonify(report)
+
+    server.add_url_rule(path, "instrumentation", instrumentation_view)
@@ -2,15 +2,34 @@ from dash import Dash, dcc, html, Input, Output, State, DiskcacheManager
 from dash.exceptions import PreventUpdate
 import dash_leaflet as dl
 import diskcache
-import pandas as pd
-import numpy as np
+import os
+import instrumentation
+from geojson_layer import selection_layer
 from osgenerator import OSGenerator
-from object_selection import isos, random_selection
+from object_selection import (
+    Deadline,
+    SelectionCancelled,
+    isos,
+    random_selection,
+)
+from precompute import load_relevant
+from datastore import store_version
+from prefetch import PrefetchCache, prefetch, seed_key
+from pyramid import SelectionPyramid
+from result_cache import ResultCache
+from selection_state import SelectionState
+from session_store import PlaceSession, SessionStore
+from viewport import adjacent_viewports
 
-from time import time
+# a store published to shared memory with `datastore.py --publish`
+STORE_DIR = os.environ.get("SOS_STORE_DIR", "data/store")
+USE_GEOBUF = True  # binary GeoJSON payload for the markers
+# seconds a selection may take before the rest is refined, 0 for no limit
+DEADLINE = float(os.environ.get("SOS_DEADLINE", 0.5))
 
 osgen = OSGenerator()
-osgen.read_from_file(
+osgen.read_from_store(
+    STORE_DIR,
     "data/friends.csv",
     "data/checkins.csv",
     "data/places.csv",
@@ -35,6 +54,13 @@ layout = html.Div(
             id="show-places-button",
             n_clicks=0,
         ),
+        dcc.Checklist(
+            id="show-context",
+            options=[{"label": "Show unselected places", "value": "on"}],
+            value=[],
+            style={"display": "inline-block"},
+        ),
+        html.Span(id="selection-status"),
         html.Br(),
         html.P(
             id="selected-user",
@@ -66,17 +92,25 @@ layout = html.Div(
         ),
         html.P(id="text-coords"),
         # Data Storage
-        dcc.Store(id="place-storage"),
-        dcc.Store(id="visitor-storage"),
+        dcc.Store(id="session-key"),
         dcc.Store(id="last-bounds-storage", data=[[0, 0], [1, 1]]),
         dcc.Store(id="last-unselected-objects", data=[]),
         dcc.Store(id="last-selected-objects", data=[]),
+        dcc.Store(id="prefetch-status"),
+        # one tick reruns a selection cut short by the deadline
+        dcc.Store(id="refine-request"),
+        dcc.Interval(id="refine-interval", interval=100, max_intervals=0),
     ]
 )
 
 cache = diskcache.Cache("./cache")
 bcm = DiskcacheManager(cache)
 app = Dash(__name__, background_callback_manager=bcm)
+sessions = SessionStore(cache)
+prefetched = PrefetchCache(cache)
+results = ResultCache(cache, store_version(STORE_DIR))
+instrumentation.share(cache)  # selections run in background processes
+instrumentation.register_routes(app.server)
 
 app.layout = layout
 
@@ -85,8 +119,7 @@ app.layout = layout
     output=[
         (Output("selected-user", "children")),
         (Output("os-string", "children")),
-        (Output("place-storage", "data")),
-        (Output("visitor-storage", "data")),
+        (Output("session-key", "data")),
     ],
     inputs=[
         (Input("load-os-button", "n_clicks")),
@@ -99,17 +132,23 @@ app.layout = layout
     ],
 )
 def load_os(n_clicks, value):
-    if value not in osgen.df_friends["user_id"]:
+    if value is None or not osgen.friend_index.contains(value)[0]:
         raise PreventUpdate
 
-    df_places, d_visitor = osgen.get_relevant_place(value, True)
-    os_string = osgen.get_object_summary(value)
+    relevant = load_relevant(STORE_DIR, value)
+    if relevant is not None:
+        df_places, d_visitor, os_string = relevant
+    else:
+        df_places, d_visitor = osgen.get_relevant_place(value, True)
+        os_string = osgen.get_object_summary(value)
+
+    session_key = sessions.new_key(value)
+    sessions.put(session_key, PlaceSession(value, df_places, d_visitor))
 
     return [
         (f"Selected user: {value}"),
         (str(os_string)),
-        (df_places.reset_index().to_json(orient="split")),
-        (d_visitor),
+        (session_key),
     ]
 
 
@@ -119,91 +158,235 @@ def load_os(n_clicks, value):
         (Output("last-bounds-storage", "data")),
         (Output("last-selected-objects", "data")),
         (Output("last-unselected-objects", "data")),
+        (Output("refine-interval", "max_intervals")),
+        (Output("refine-request", "data")),
+        (Output("selection-status", "children")),
     ],
     inputs=[
         (Input("show-places-button", "n_clicks")),
+        (Input("refine-interval", "n_intervals")),
+        (State("refine-request", "data")),
         (State("map", "bounds")),
-        (State("place-storage", "data")),
-        (State("visitor-storage", "data")),
+        (State("session-key", "data")),
         (State("last-bounds-storage", "data")),
         (State("last-selected-objects", "data")),
         (State("last-unselected-objects", "data")),
+        (State("show-context", "value")),
     ],
     prevent_initial_call=True,
-    running=[
-        (Output("show-places-button", "disabled"), True, False),
-        (Output("load-os-button", "disabled"), True, False),
-    ],
+    background=True,
+    # a new click terminates the running job, as does loading another user
+    cancel=[Input("load-os-button", "n_clicks")],
 )
 def display_os_on_map(
     n_clicks,
+    n_intervals,
+    refine,
     current_bounds,
-    place_data,
-    visitor_data,
+    session_key,
     last_bounds,
     displayed_objs,
     undisplayed_objs,
+    show_context,
 ):
-    start = time()
-    print(f"displayed places: {displayed_objs}")
-    print(f"# hidden places: {len(undisplayed_objs)}")
+    # a refinement reruns the request whose result was cut short, unless a
+    # click came after it
+    is_refining = refine is not None and refine["n_clicks"] == n_clicks
+    if is_refining:
+        current_bounds = refine["bounds"]
+        last_bounds = refine["last_bounds"]
+        displayed_objs = refine["D"]
+        undisplayed_objs = refine["G"]
+    deadline = None
+    if DEADLINE > 0 and not is_refining:
+        deadline = Deadline(DEADLINE)
 
-    if place_data is None:
-        raise PreventUpdate
+    # jobs Dash could not terminate see the newer click and give up
+    sessions.mark_latest(session_key, n_clicks)
 
-    visitor_data = {int(k): visitor_data[k] for k in visitor_data.keys()}
-
-    df_places = (
-        pd.read_json(place_data, orient="split")
-        .iloc[:, 1:]
-        .astype(
-            {
-                "place_id": int,
-                "lat": np.float32,
-                "lon": np.float32,
-                "country_id": int,
-                "is_direct": int,
-                "weight": np.float32,
-            }
-        )
-    )
-
-    start = time()
-    new_selected, new_unselected = isos(
-        df_places,
-        visitor_data,
-        last_bounds,
-        current_bounds,
-        10,
-        displayed_objs,
-        undisplayed_objs,
-    )
-
-    points = [
-        dl.Marker(
-            position=[lat, lon],
-            children=dl.Tooltip(
-                f"place_id: {int(id)}",
-            ),
-            opacity=1 if is_direct else 0.5,
+    def is_superseded():
+        return not sessions.is_latest(session_key, n_clicks)
+
+    with instrumentation.request("display_os_on_map"):
+        with instrumentation.span("display.session_load"):
+            session = sessions.get(session_key)
+            if session is None:
+                raise PreventUpdate
+            df_places = session.df_places
+
+        # the same request was answered before, in any session
+        hit = results.get(
+            session,
+            current_bounds,
+            10,
+            last_bounds,
+            displayed_objs,
+            undisplayed_objs,
         )
-        for id, lat, lon, _, is_direct, _ in df_places[
-            df_places["place_id"].isin(new_selected)
-        ].itertuples(index=False)
-    ]
+        instrumentation.count("result_cache.hit", int(hit is not None))
+
+        if hit is None:
+            # the adjacent viewports were selected from this very D/G
+            hit = prefetched.get(
+                session_key,
+                current_bounds,
+                seed_key(
+                    session,
+                    last_bounds,
+                    current_bounds,
+                    displayed_objs,
+                    undisplayed_objs,
+                ),
+            )
+            instrumentation.count("prefetch.hit", int(hit is not None))
+
+        is_complete = True
+        if hit is not None:
+            current_bounds, new_selected, new_unselected = hit
+        else:
+            with instrumentation.span("display.session_load"):
+                state = (
+                    sessions.get(f"{session_key}:selection")
+                    or SelectionState()
+                )
+                pyramid = sessions.get(
+                    f"{session_key}:pyramid"
+                ) or SelectionPyramid(10)
+
+            with instrumentation.span("display.isos"):
+                try:
+                    new_selected, new_unselected = isos(
+                        df_places,
+                        session.visitors,
+                        last_bounds,
+                        current_bounds,
+                        10,
+                        displayed_objs,
+                        undisplayed_objs,
+                        index=session.index,
+                        state=state,
+                        pyramid=pyramid,
+                        should_stop=is_superseded,
+                        deadline=deadline,
+                    )
+                except SelectionCancelled:
+                    instrumentation.count("display.cancelled")
+                    raise PreventUpdate
+
+            with instrumentation.span("display.session_save"):
+                sessions.put(f"{session_key}:selection", state)
+
+            is_complete = deadline is None or not deadline.missed
+            instrumentation.count("display.complete", int(is_complete))
+            if is_complete:
+                results.put(
+                    session,
+                    current_bounds,
+                    10,
+                    last_bounds,
+                    displayed_objs,
+                    undisplayed_objs,
+                    new_selected,
+                    new_unselected,
+                )
 
-    print(f"Time elapsed: {np.round(time()-start, 2)} second(s)")
-    print(f"selected points: {new_selected}")
-    print()
+        with instrumentation.span("display.markers"):
+            points = selection_layer(
+                df_places,
+                new_selected,
+                new_unselected if show_context else None,
+                geobuf=USE_GEOBUF,
+            )
+
+    if is_complete:
+        refine, status = None, ""
+    else:
+        refine = {
+            "n_clicks": n_clicks,
+            "bounds": current_bounds,
+            "last_bounds": last_bounds,
+            "D": displayed_objs,
+            "G": undisplayed_objs,
+        }
+        status = "Refining selection..."
 
     return [
         (points),
         (current_bounds),
         (list(new_selected)),
         (list(new_unselected)),
+        (n_intervals + (0 if is_complete else 1)),
+        (refine),
+        (status),
     ]
 
 
+@app.callback(
+    Output("prefetch-status", "data"),
+    inputs=[
+        (Input("last-bounds-storage", "data")),
+        (State("session-key", "data")),
+        (State("last-selected-objects", "data")),
+        (State("last-unselected-objects", "data")),
+        (State("show-places-button", "n_clicks")),
+    ],
+    prevent_initial_call=True,
+    background=True,
+    cancel=[Input("load-os-button", "n_clicks")],
+)
+def prefetch_viewports(
+    bounds, session_key, displayed_objs, undisplayed_objs, n_clicks
+):
+    # selections for the next zoom and pan, then the pyramid tiles of this
+    # and those viewports, given up on the next click
+    session = sessions.get(session_key)
+    if session is None:
+        raise PreventUpdate
+
+    with instrumentation.request("prefetch_viewports"):
+        state = sessions.get(f"{session_key}:selection") or SelectionState()
+        pyramid = sessions.get(f"{session_key}:pyramid") or SelectionPyramid(
+            10
+        )
+        n_tiles = len(pyramid.tiles)
+
+        def should_stop():
+            return not sessions.is_latest(session_key, n_clicks)
+
+        try:
+            n_prefetched = prefetch(
+                prefetched,
+                session_key,
+                session,
+                bounds,
+                displayed_objs,
+                undisplayed_objs,
+                10,
+                state=state,
+                pyramid=pyramid,
+                should_stop=should_stop,
+            )
+            instrumentation.count("prefetch.viewports", n_prefetched)
+            with instrumentation.span("prefetch.pyramid"):
+                for view in [bounds, *adjacent_viewports(bounds).values()]:
+                    pyramid.build(
+                        session.df_places,
+                        session.visitors,
+                        session.index,
+                        view,
+                        should_stop,
+                    )
+        except SelectionCancelled:
+            instrumentation.count("prefetch.cancelled")
+            raise PreventUpdate
+        finally:
+            # tiles built before a cancellation are kept as well
+            if len(pyramid.tiles) > n_tiles:
+                sessions.put(f"{session_key}:pyramid", pyramid)
+
+    return n_prefetched
+
+
 @app.callback(Output("text-coords", "children"), Input("map", "bounds"))
 def show_border(bounds):
     return str(bounds)
@@ -1,58 +1,269 @@
+import heapq
+
 import numpy as np
-from metrics import haversine, euclidean
+from metrics import distance_to_many
+from spatial_index import SpatialIndex
 
 
 class Maxheap:
-    def __init__(self, id, lat, lon, gain, iter):
-        sort_idx = np.argsort(gain)[::-1]
+    """Max-priority queue of (id, iter, lat, lon, gain) records.
+
+    Records live in slot arrays. The initial records are sorted once by
+    (-gain, seq), a sorted array being a valid heap, and read from a cursor;
+    re-inserted records go to a binary heap of `(-gain, seq, slot, version)`
+    keys. Popping takes the smaller of both tops, so popping and pushing
+    cost O(log n) and building costs one argsort. Deleting a place only
+    marks its slot dead (tombstone) in O(1); dead or outdated records are
+    skipped once they surface at the top. Records of equal gain pop in
+    order of `seq`: the initial records in input order, then re-inserted
+    ones in the order they were inserted. (The former sorted-array stack,
+    built from `argsort(gain)[::-1]`, popped ties in reverse input order.)
+
+    `delete_neighbors` asks `index`, the `SpatialIndex` of the session,
+    for the places within the radius when given along with `index_pos`,
+    the positions of the records in it; otherwise it scans the live records.
+    A record is assumed to keep its coordinates when it is re-inserted. Its
+    radius is measured with `metric`, see `metrics.METRICS`.
+    """
+
+    def __init__(
+        self,
+        id,
+        lat,
+        lon,
+        gain,
+        iter,
+        metric="planar",
+        index: SpatialIndex = None,
+        index_pos=None,
+    ):
+        # gains are ranked as stored (float32), equal ones in input order
+        gain = np.asarray(gain, dtype=np.float32)
+        sort_idx = np.argsort(-gain, kind="stable")
+        n = len(sort_idx)
 
-        self.float_stack = np.array([lat, lon, gain], dtype=np.float32).T
-        self.int_stack = np.array([id, iter], dtype=np.int32).T  # place_id
+        self._id = np.asarray(id, dtype=np.int32)[sort_idx]
+        self._iter = np.asarray(iter, dtype=np.int32)[sort_idx]
+        self._lat = np.asarray(lat, dtype=np.float32)[sort_idx]
+        self._lon = np.asarray(lon, dtype=np.float32)[sort_idx]
+        self._gain = gain[sort_idx]
+        self._seq = np.arange(n, dtype=np.int64)
+        self._version = np.zeros(n, dtype=np.int64)
+        self._alive = np.ones(n, dtype=bool)
 
-        self.float_stack = self.float_stack[sort_idx]
-        self.int_stack = self.int_stack[sort_idx]
+        self._n_slot = n
+        self._n_alive = n
+        self._next_seq = n
+        self.metric = metric
+
+        # slots [0, n) in key order, valid while alive and not re-inserted
+        self._n_run = n
+        self._cursor = 0
+        self._heap = []
+
+        # place_id -> slot, of popped records first as `greedy_sos` only
+        # re-inserts those; the full map is made when something else is
+        self._popped = {}
+        self._slot = None
+
+        self._index = index
+        if index is not None:
+            index_pos = np.asarray(index_pos, dtype=np.int64)[sort_idx]
+            self._pos_order = np.argsort(index_pos)
+            self._sorted_pos = index_pos[self._pos_order]
 
     def __repr__(self):
         n = min(len(self), 40)
+        slots = np.flatnonzero(self._alive[: self._n_slot])
+        slots = slots[np.lexsort((self._seq[slots], -self._gain[slots]))][:n]
         return str(
             np.concatenate(
-                [self.int_stack[:n], self.float_stack[:n, :]],
+                [
+                    np.array([self._id[slots], self._iter[slots]]).T,
+                    np.array(
+                        [self._lat[slots], self._lon[slots], self._gain[slots]]
+                    ).T,
+                ],
                 axis=1,
             )
         )
 
     def __len__(self):
-        return len(self.int_stack)
+        return self._n_alive
 
     def poptop(self):
-        top = (self.int_stack[:1, :], self.float_stack[:1, :])
-        self.int_stack = self.int_stack[1:, :]
-        self.float_stack = self.float_stack[1:, :]
-        return top
+        run_slot = self._run_top()
+        heap_key = self._heap_top()
+        if run_slot is None and heap_key is None:
+            return (
+                np.empty((0, 2), dtype=np.int32),
+                np.empty((0, 3), dtype=np.float32),
+            )
 
-    def insert(self, int_arr, float_arr):
-        if len(self.float_stack) == 0:
-            insert_idx = 0
-        elif self.float_stack[-1, 2] > float_arr[0, 2]:
-            insert_idx = len(self)
+        if heap_key is None or (
+            run_slot is not None
+            and (-float(self._gain[run_slot]), int(self._seq[run_slot]))
+            < heap_key[:2]
+        ):
+            slot = run_slot
+            self._cursor += 1
         else:
-            insert_idx = np.argmax(self.float_stack[:, 2] < float_arr[0, 2])
+            slot = heapq.heappop(self._heap)[2]
+
+        self._alive[slot] = False
+        self._n_alive -= 1
+        self._popped[int(self._id[slot])] = slot
+        return (
+            np.array([[self._id[slot], self._iter[slot]]], np.int32),
+            np.array(
+                [[self._lat[slot], self._lon[slot], self._gain[slot]]],
+                np.float32,
+            ),
+        )
+
+    def _run_top(self):
+        # skips dead and re-inserted slots a block at a time
+        while self._cursor < self._n_run:
+            block = slice(self._cursor, min(self._cursor + 256, self._n_run))
+            valid = np.flatnonzero(
+                self._alive[block] & (self._version[block] == 0)
+            )
+            if len(valid) > 0:
+                self._cursor += int(valid[0])
+                return self._cursor
+            self._cursor = block.stop
+        return None
+
+    def _heap_top(self):
+        while self._heap:
+            key = self._heap[0]
+            slot, version = key[2], key[3]
+            if self._alive[slot] and self._version[slot] == version:
+                return key
+            heapq.heappop(self._heap)
+        return None
+
+    def insert(self, int_arr, float_arr):
+        place_id = int(int_arr[0, 0])
+        slot = self._popped.pop(place_id, None)
+        if slot is None:
+            slots = self._slot_map()
+            slot = slots.get(place_id)
+            if slot is None:
+                slot = self._new_slot()
+                slots[place_id] = slot
 
-        self.int_stack = np.insert(self.int_stack, insert_idx, int_arr, 0)
-        self.float_stack = np.insert(
-            self.float_stack, insert_idx, float_arr, 0
+        if self._alive[slot]:
+            self._n_alive -= 1  # replaces the record still in the heap
+
+        self._id[slot] = place_id
+        self._iter[slot] = int_arr[0, 1]
+        self._lat[slot], self._lon[slot], self._gain[slot] = float_arr[0, :3]
+        self._seq[slot] = self._next_seq
+        self._version[slot] += 1
+        self._alive[slot] = True
+
+        self._next_seq += 1
+        self._n_alive += 1
+        heapq.heappush(
+            self._heap,
+            (
+                -float(self._gain[slot]),
+                int(self._seq[slot]),
+                slot,
+                int(self._version[slot]),
+            ),
         )
 
     def delete(self, arr):
-        keep_idx = ~np.isin(self.int_stack[:, 0], arr)
-        self.int_stack = self.int_stack[keep_idx]
-        self.float_stack = self.float_stack[keep_idx]
+        slots = self._slot_map()
+        for place_id in np.atleast_1d(arr).tolist():
+            slot = slots.get(place_id)
+            if slot is not None and self._alive[slot]:
+                self._alive[slot] = False
+                self._n_alive -= 1
+
+        self._compact()
 
     def delete_neighbors(self, lat, lon, radius):
-        stack_lat = self.float_stack[:, 0]
-        stack_lon = self.float_stack[:, 1]
+        if self._index is None:
+            slots = np.flatnonzero(self._alive[: self._n_slot])
+            is_near = ~(
+                distance_to_many(
+                    lat, lon, self._lat[slots], self._lon[slots], self.metric
+                )
+                > radius
+            )
+            drop_slot = slots[is_near]
+        else:
+            pos = self._index.query_radius(lat, lon, radius, self.metric)
+            at = np.minimum(
+                np.searchsorted(self._sorted_pos, pos),
+                len(self._sorted_pos) - 1,
+            )
+            drop_slot = self._pos_order[at[self._sorted_pos[at] == pos]]
+
+            # slots added by `insert` after construction are not in the index
+            new_slot = np.arange(self._n_run, self._n_slot)
+            is_near = ~(
+                distance_to_many(
+                    lat,
+                    lon,
+                    self._lat[new_slot],
+                    self._lon[new_slot],
+                    self.metric,
+                )
+                > radius
+            )
+            drop_slot = np.concatenate([drop_slot, new_slot[is_near]])
+        drop_slot = drop_slot[self._alive[drop_slot]]
 
-        index_keep = euclidean(lat, lon, stack_lat, stack_lon) > radius
+        self._alive[drop_slot] = False
+        self._n_alive -= len(drop_slot)
+        self._compact()
 
-        self.int_stack = self.int_stack[index_keep]
-        self.float_stack = self.float_stack[index_keep]
+    def _slot_map(self):
+        if self._slot is None:
+            self._slot = dict(
+                zip(self._id[: self._n_slot].tolist(), range(self._n_slot))
+            )
+        return self._slot
+
+    def _new_slot(self):
+        if self._n_slot == len(self._id):
+            capacity = max(16, 2 * len(self._id))
+            for name in [
+                "_id",
+                "_iter",
+                "_lat",
+                "_lon",
+                "_gain",
+                "_seq",
+                "_version",
+                "_alive",
+            ]:
+                old = getattr(self, name)
+                new = np.zeros(capacity, dtype=old.dtype)
+                new[: len(old)] = old
+                setattr(self, name, new)
+
+        self._n_slot += 1
+        return self._n_slot - 1
+
+    def _compact(self):
+        # drop tombstoned keys once they outnumber the live records
+        if len(self._heap) <= 2 * self._n_alive + 1024:
+            return
+
+        slots = np.flatnonzero(
+            self._alive[: self._n_slot] & (self._version[: self._n_slot] > 0)
+        )
+        self._heap = list(
+            zip(
+                (-self._gain[slots].astype(np.float64)).tolist(),
+                self._seq[slots].tolist(),
+                slots.tolist(),
+                self._version[slots].tolist(),
+            )
+        )
+        heapq.heapify(self._heap)
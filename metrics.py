@@ -1,7 +1,16 @@
 import numpy as np
 
+EARTH_RADIUS = 6371  # km
+
 
 def jaccard(seq1, seq2):
+    from bitset import count_bits, is_bitset  # imports scipy, so lazily
+
+    if is_bitset(seq1) and is_bitset(seq2):
+        # packed rows of `bitset.pack`, broadcast against each other
+        n_intersect = count_bits(seq1 & seq2)
+        return n_intersect / count_bits(seq1 | seq2)
+
     set1, set2 = set(seq1), set(seq2)
     n_intersect = len(set1 & set2)
     n_union = len(seq1) + len(seq2) - n_intersect
@@ -9,6 +18,12 @@ def jaccard(seq1, seq2):
 
 
 def overlap_coeff(seq1, seq2):
+    from bitset import count_bits, is_bitset
+
+    if is_bitset(seq1) and is_bitset(seq2):
+        n_intersect = count_bits(seq1 & seq2)
+        return n_intersect / np.minimum(count_bits(seq1), count_bits(seq2))
+
     set1, set2 = set(seq1), set(seq2)
     return len(set1 & set2) / min(len(set1), len(set2))
 
@@ -23,10 +38,92 @@ def haversine(lat1, lon1, lat2, lon2):
         + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2.0) ** 2
     )
     c = 2 * np.arcsin(np.sqrt(a))
-    km = 6371 * c
+    km = EARTH_RADIUS * c
 
     return km
 
 
 def euclidean(lat1, lon1, lat2, lon2):
     return np.sqrt(np.power(lat1 - lat2, 2) + np.power(lon1 - lon2, 2))
+
+
+def equirectangular(lat1, lon1, lat2, lon2):
+    """km between points projected on the plane tangent at their mean
+    latitude, close to `haversine` at viewport scale"""
+    dlon = lon2 - lon1
+    dlon = np.radians(dlon - 360 * np.round(dlon / 360))  # across +-180
+    lat1, lat2 = np.radians(lat1), np.radians(lat2)
+    x = dlon * np.cos((lat1 + lat2) / 2)
+    y = lat2 - lat1
+
+    return EARTH_RADIUS * np.sqrt(x * x + y * y)
+
+
+# name -> (distance function, unit)
+METRICS = {
+    "planar": (euclidean, "degree"),
+    "equirectangular": (equirectangular, "km"),
+    "haversine": (haversine, "km"),
+}
+
+
+def get_metric(metric):
+    """Distance function of `metric`, a name of `METRICS` or a callable
+    with the signature of `euclidean`"""
+    if callable(metric):
+        return metric
+    if metric not in METRICS:
+        raise ValueError(
+            f"Unknown metric {metric}, expected one of {list(METRICS)}"
+        )
+    return METRICS[metric][0]
+
+
+def distance_to_many(
+    lat, lon, lats, lons, metric="planar", dtype=np.float32, chunk_size=2**16
+) -> np.ndarray:
+    """Distances from (lat, lon) to every (lats[i], lons[i])"""
+    distance = get_metric(metric)
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    lat, lon = dtype(lat), dtype(lon)
+
+    out = np.empty(len(lats), dtype=dtype)
+    for start in range(0, len(lats), chunk_size):
+        stop = start + chunk_size
+        out[start:stop] = distance(
+            lat,
+            lon,
+            lats[start:stop].astype(dtype, copy=False),
+            lons[start:stop].astype(dtype, copy=False),
+        )
+    return out
+
+
+def pairwise_distance(
+    lats1,
+    lons1,
+    lats2=None,
+    lons2=None,
+    metric="planar",
+    dtype=np.float32,
+    chunk_size=2**20,
+) -> np.ndarray:
+    """(len(lats1), len(lats2)) matrix of distances, computed in blocks of
+    about `chunk_size` pairs so temporaries stay bounded"""
+    distance = get_metric(metric)
+    lats1 = np.asarray(lats1).astype(dtype, copy=False)
+    lons1 = np.asarray(lons1).astype(dtype, copy=False)
+    if lats2 is None:
+        lats2, lons2 = lats1, lons1
+    lats2 = np.asarray(lats2).astype(dtype, copy=False)
+    lons2 = np.asarray(lons2).astype(dtype, copy=False)
+
+    out = np.empty((len(lats1), len(lats2)), dtype=dtype)
+    n_rows = max(1, chunk_size // max(1, len(lats2)))
+    for start in range(0, len(lats1), n_rows):
+        stop = start + n_rows
+        out[start:stop] = distance(
+            lats1[start:stop, None], lons1[start:stop, None], lats2, lons2
+        )
+    return out
@@ -10,10 +10,68 @@ sos.py: A module that implements Spatial Object Selection (SOS)
 6. G (List of items that were within map border but not shown)
 """
 
-from metrics import jaccard, euclidean
+from metrics import distance_to_many, get_metric
 import pandas as pd
 import numpy as np
+import instrumentation
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 from maxheap import Maxheap
+from pyramid import SelectionPyramid
+from selection_state import SelectionState
+from spatial_index import SpatialIndex
+from viewport import move_kind
+from visitor_matrix import VisitorMatrix
+
+# threads evaluating initial gains, opt in as they only pay off on some
+# machines (see the "gains" suite of benchmarks/run.py), similarities held
+# per block, and blocks per thread so none idles behind a slow block
+N_WORKERS = int(os.environ.get("SOS_WORKERS", 1))
+CHUNK_ELEMENTS = 2**18
+BLOCKS_PER_WORKER = 4
+_thread_pools = {}
+
+# heap pops between two calls of `should_stop`
+CANCEL_CHECK_EVERY = 64
+
+# share of the window the candidates must make up for the window graph to
+# pay off; fewer candidates, e.g. those of pyramid tiles, are scored from
+# rows computed on demand
+GRAPH_MIN_CANDIDATES = 0.1
+
+
+class SelectionCancelled(Exception):
+    """Raised when `should_stop` reports that the selection is obsolete"""
+
+
+class Deadline:
+    """Time a selection has to be returned by. `missed` tells whether the
+    selection was cut short and so is not the one without a deadline."""
+
+    def __init__(self, seconds: float):
+        self.at = perf_counter() + seconds
+        self.missed = False
+
+    def expired(self) -> bool:
+        if not self.missed and perf_counter() >= self.at:
+            self.missed = True
+        return self.missed
+
+
+class Approximation:
+    """Opt-in approximations of `greedy_sos` for large windows, seeded
+
+    epsilon      stochastic greedy: every pick scores a random subset of
+                 (n / k) log(1 / epsilon) of the n candidates
+    sample_size  Score(S|O) is estimated from this many draws of O, with
+                 probability proportional to the weights; None for all of O
+    """
+
+    def __init__(self, epsilon=0.1, sample_size=None, seed=0):
+        self.epsilon = epsilon
+        self.sample_size = sample_size
+        self.seed = seed
 
 
 def random_selection(df_place: pd.DataFrame, bound: list, k: int):
@@ -32,70 +90,106 @@ def random_selection(df_place: pd.DataFrame, bound: list, k: int):
 
 def isos(
     df_place: pd.DataFrame,
-    d_visitor: dict,
+    d_visitor,  # dict or VisitorMatrix
     border_prev: list,
     border_now: list,
     k: int = 10,
     D: list = [],
     G: list = [],
+    index: SpatialIndex = None,
+    state: SelectionState = None,
+    pyramid: SelectionPyramid = None,
+    metric: str = "planar",
+    should_stop=None,
+    deadline: Deadline = None,
+    approx: Approximation = None,
 ):
     [lat1, lon1], [lat2, lon2] = border_now  # [bottom left] [upper right]
-    [lat1p, lon1p], [lat2p, lon2p] = border_prev
 
-    separation_distance = euclidean(lat1, lon1, lat2, lon1) * 0.1
-    print(f"Separation distance: {separation_distance} degrees")
+    # degrees for the planar metric, km for the geographic ones
+    separation_distance = get_metric(metric)(lat1, lon1, lat2, lon1) * 0.1
 
-    is_zoomin = (lat1p < lat1 < lat2 < lat2p) & (lon1p < lon1 < lon2 < lon2p)
-    is_zoomout = (lat1 < lat1p < lat2p < lat2) & (lon1 < lon1p < lon2p < lon2)
-    is_panning = not (is_zoomin or is_zoomout)
+    move = move_kind(border_prev, border_now)
+    is_zoomin = move == "zoom_in"
+    is_zoomout = move == "zoom_out"
+    is_panning = move == "pan"
 
-    df_place = df_place[
-        (df_place["lat"].between(lat1, lat2))
-        & (df_place["lon"].between(lon1, lon2))
-    ].drop(
-        columns=["country_id", "is_direct"]
-    )  # selects objects located within current border [pid, lat, lon, cid, isdirect, w]
-    print(f"# objects in current window: {len(df_place)}")
+    with instrumentation.span("isos.viewport_filter"):
+        if index is None:
+            index = SpatialIndex(df_place["lat"], df_place["lon"])
+
+        window_idx = index.query_bbox(lat1, lon1, lat2, lon2)
+        df_place = df_place.iloc[window_idx].drop(
+            columns=["country_id", "is_direct"]
+        )  # selects objects located within current border [pid, lat, lon, cid, isdirect, w]
+    instrumentation.count("isos.window_size", len(df_place))
+    if len(df_place) == 0:
+        return ([], [])
 
-    df_place_placeid = df_place["place_id"].to_list()
+    df_place_placeid = set(df_place["place_id"].to_list())
     if is_zoomin:
         S = [d for d in D if d in df_place_placeid]
         G = []
-        print("Zoomin registered")
+        instrumentation.count("isos.zoomin")
     elif is_zoomout:
         S = []
         G = [g for g in G if g in df_place_placeid]
-        print("Zoomout registered")
+        instrumentation.count("isos.zoomout")
     elif is_panning:
         S = [d for d in D if d in df_place_placeid]
         G = [g for g in G if g in df_place_placeid]
-        print("Panning registered")
+        instrumentation.count("isos.panning")
 
-    print(f"initial S: {S}")
-
-    print(len(df_place))
-    df_maxheap = df_place[~(df_place["place_id"].isin(G))]
-    print(len(df_maxheap))
+    is_candidate = ~(df_place["place_id"].isin(G)).to_numpy()
 
     # removing all points that are close to already chosen points from previous frame
-    for s in S:
-        maxheap_lats = df_maxheap.lat.values
-        maxheap_lons = df_maxheap.lon.values
-
-        s_lat = df_place[df_place.place_id == s].lat.values[0]
-        s_lon = df_place[df_place.place_id == s].lon.values[0]
-        keep_idx = (
-            euclidean(s_lat, s_lon, maxheap_lats, maxheap_lons)
-            > separation_distance
-        )
-
-        if np.sum(keep_idx) != len(keep_idx):
-            print(
-                f"Pruned {len(keep_idx) - np.sum(keep_idx)} points too close to {s}"
+    with instrumentation.span("isos.pruning"):
+        s_window_pos = pd.Index(df_place["place_id"]).get_indexer(S)
+        for s, s_pos in zip(S, s_window_pos):
+            s_lat = df_place["lat"].values[s_pos]
+            s_lon = df_place["lon"].values[s_pos]
+
+            # neighbours are positions in the full table, keep those in window
+            neighbor_idx = index.query_radius(
+                s_lat, s_lon, separation_distance, metric
+            )
+            neighbor_pos = np.searchsorted(window_idx, neighbor_idx)
+            neighbor_pos = neighbor_pos[
+                window_idx[np.minimum(neighbor_pos, len(window_idx) - 1)]
+                == neighbor_idx
+            ]
+
+            instrumentation.count(
+                "isos.pruned", np.sum(is_candidate[neighbor_pos])
+            )
+            is_candidate[neighbor_pos] = False
+
+    if pyramid is not None:
+        # only the selections of the overlapping tiles compete, unless they
+        # are not built yet or cannot fill the remaining slots while the
+        # window holds more; tiles are built off the request path with
+        # `SelectionPyramid.build`
+        tile_candidates = pyramid.candidates(border_now)
+        if tile_candidates is None:
+            instrumentation.count("isos.pyramid_miss")
+        else:
+            is_tile_candidate = is_candidate & (
+                df_place["place_id"].isin(tile_candidates).to_numpy()
             )
+            instrumentation.count(
+                "isos.tile_candidates", np.sum(is_tile_candidate)
+            )
+
+            is_filled = np.sum(is_tile_candidate) >= k - len(S)
+            if is_filled or pyramid.saturated(border_now):
+                is_candidate = is_tile_candidate
+                state = None  # a handful of candidates are cheap to score
 
-        df_maxheap = df_maxheap[keep_idx]
+    if approx is not None:
+        state = None  # it keeps the exact gains over every place
 
+    instrumentation.count("isos.candidates", np.sum(is_candidate))
+    df_maxheap = df_place[is_candidate]
     maxheap_data = [
         df_maxheap["place_id"].to_numpy(),
         df_maxheap["lat"].to_numpy(),
@@ -110,125 +204,380 @@ def isos(
         k,
         separation_distance,
         S,
+        state,
+        metric,
+        should_stop,
+        deadline,
+        approx,
+        index,
+        window_idx[is_candidate],
     )
 
-    new_G = [pid for pid in df_place.place_id if pid not in new_S]
+    new_S_set = set(new_S)
+    new_G = [pid for pid in df_place.place_id if pid not in new_S_set]
     return (new_S, new_G)
 
 
 def greedy_sos(
     maxheap_data: list,
     df_place: pd.DataFrame,  # [pid, lat, lon, w]
-    d_visitor: dict,
+    d_visitor,  # dict or VisitorMatrix
     k: int,
     min_distance: float,
     S: list,
+    state: SelectionState = None,
+    metric: str = "planar",
+    should_stop=None,
+    deadline: Deadline = None,
+    approx: Approximation = None,
+    index: SpatialIndex = None,
+    index_pos=None,
 ):
-    place_order = df_place.place_id.to_list()
+    # `should_stop()` is polled while selecting, SelectionCancelled is raised
+    # once it returns True. Past the `deadline`, gains not computed yet are
+    # estimated and the remaining slots are filled without re-evaluating
+    # stale gains, i.e. from upper bounds. `index_pos` are the positions of
+    # the candidates in `index`, the spatial index of the session, which
+    # then answers the neighbour deletions.
+    if should_stop is None:
+        should_stop = _never_stop
+    if should_stop():
+        raise SelectionCancelled
+    if approx is not None:
+        return stochastic_greedy_sos(
+            maxheap_data,
+            df_place,
+            d_visitor,
+            k,
+            min_distance,
+            S,
+            approx,
+            metric,
+            should_stop,
+            deadline,
+        )
+
+    place_order = df_place.place_id.to_numpy()
     weights = df_place.weight.to_numpy()
 
+    # rows of `visitors` follow `place_order`, i.e. the set O
+    if isinstance(d_visitor, dict):
+        d_visitor = VisitorMatrix.from_dict(d_visitor)
+    # the graph is sliced from `d_visitor` if it has one. When the deadline
+    # cuts its build short, or there are too few candidates for it to pay
+    # off, rows are computed on demand instead.
+    with instrumentation.span("greedy.subset"):
+        visitors = d_visitor.subset(place_order)
+    if len(maxheap_data[0]) >= GRAPH_MIN_CANDIDATES * len(place_order):
+        with instrumentation.span("greedy.similarity_graph"):
+            visitors.build_similarity_graph(deadline=deadline)
+
     id_maxheap = maxheap_data[0]
     iter_maxheap = np.ones_like(maxheap_data[0]) * len(S)
 
     lat_maxheap = maxheap_data[1]
     lon_maxheap = maxheap_data[2]
 
-    # Calculates sim(o, S) \forall o \in O, a set of size len(place_id_list)
-    sim_oS = np.zeros(len(place_order))
-    for s in S:
-        sim_oS = update_sim_oS(sim_oS, s, place_order, d_visitor)
+    with instrumentation.span("greedy.initial_gains"):
+        if state is not None:
+            # sim(o, S) and the gains carried over from the previous frame
+            sim_oS, gain_maxheap = state.prepare(
+                d_visitor, visitors, weights, S, id_maxheap
+            )
+        else:
+            # Calculates sim(o, S) \forall o \in O, a set of size len(place_id_list)
+            instrumentation.count(
+                "greedy.similarity_rows", len(S) + len(id_maxheap)
+            )
+            sim_oS = np.zeros(len(place_order))
+            for s in S:
+                update_sim_oS(sim_oS, s, visitors)
 
-    # Calculates score(S|O)
-    score_S = calc_score_OS(weights, sim_oS)  # scalar
+            # Score(S \cup o|O) - Score(S|O) for all o \in O
+            gain_maxheap = calc_initial_gain(
+                sim_oS,
+                id_maxheap,
+                visitors,
+                weights,
+                deadline=deadline,
+                should_stop=should_stop,
+            )  # array
+
+    with instrumentation.span("greedy.heap_build"):
+        maxheap = Maxheap(
+            id_maxheap,
+            lat_maxheap,
+            lon_maxheap,
+            gain_maxheap,
+            iter_maxheap,
+            metric,
+            index,
+            index_pos,
+        )
 
-    # calculates calculates Score(Suo|O) \forall o \in O
-    score_Suo = calc_initial_score_Suo(
-        sim_oS,
-        id_maxheap,
-        place_order,
-        d_visitor,
-        weights,
-    )  # array
-
-    # Score(S \cup o|O) - Score(S|O) for all o \in O
-    gain_maxheap = score_Suo - score_S  # array - scalar
-
-    maxheap = Maxheap(
-        id_maxheap,
-        lat_maxheap,
-        lon_maxheap,
-        gain_maxheap,
-        iter_maxheap,
-    )
+    if should_stop():
+        raise SelectionCancelled
 
-    while len(S) < k and len(maxheap) > 0:
-        # t_ints = [[`t_place_id`, `t_iter`]]
-        # t_float = [[`t_lat`, `t_lon`, `t_score_gain`]]
-        t_ints, t_floats = maxheap.poptop()
-        new_sim_oS, new_score_S = sim_oS, score_S
+    n_pops = 0
+    with instrumentation.span("greedy.lazy_loop"):
+        while len(S) < k and len(maxheap) > 0:
+            # t_ints = [[`t_place_id`, `t_iter`]]
+            # t_float = [[`t_lat`, `t_lon`, `t_score_gain`]]
+            t_ints, t_floats = maxheap.poptop()
 
-        while t_ints[0, 1] != len(S):
-            new_sim_oS = update_sim_oS(
-                sim_oS,
-                t_ints[0, 0],
-                place_order,
-                d_visitor,
-            )
-            new_score_S = calc_score_OS(weights, new_sim_oS)
+            while t_ints[0, 1] != len(S) and not (
+                deadline is not None and deadline.expired()
+            ):
+                instrumentation.count("greedy.stale_reinserts")
+                instrumentation.count("greedy.similarity_rows")
+                t_floats[0, 2] = calc_gain(
+                    sim_oS, t_ints[0, 0], visitors, weights
+                )
+                t_ints[0, 1] = len(S)
+                maxheap.insert(t_ints, t_floats)
+                t_ints, t_floats = maxheap.poptop()
+
+                n_pops += 1
+                if n_pops % CANCEL_CHECK_EVERY == 0 and should_stop():
+                    instrumentation.count("greedy.cancelled")
+                    raise SelectionCancelled
+
+            if t_ints[0, 1] != len(S):
+                instrumentation.count("greedy.deadline_fills")
+
+            update_sim_oS(sim_oS, t_ints[0, 0], visitors)
+            S.append(t_ints[0, 0])
+
+            # Remove all locations within the distance of \theta from `t` from maxheap
+            t_lat, t_lon = t_floats[0, :2]
+            maxheap.delete_neighbors(t_lat, t_lon, min_distance)
 
-            t_floats[0, 2] = new_score_S - score_S
-            t_ints[0, 1] = len(S)
-            maxheap.insert(t_ints, t_floats)
-            t_ints, t_floats = maxheap.poptop()
+    return S
 
-        sim_oS, score_S = new_sim_oS, new_score_S
-        S.append(t_ints[0, 0])
 
-        # Remove all locations within the distance of \theta from `t` from maxheap
-        t_lat, t_lon = t_floats[0, :2]
-        maxheap.delete_neighbors(t_lat, t_lon, min_distance)
+def _never_stop():
+    return False
 
-    print(f"Score of the new S: {score_S}")
+
+def stochastic_greedy_sos(
+    maxheap_data: list,
+    df_place: pd.DataFrame,  # [pid, lat, lon, w]
+    d_visitor,  # dict or VisitorMatrix
+    k: int,
+    min_distance: float,
+    S: list,
+    approx: Approximation,
+    metric: str = "planar",
+    should_stop=None,
+    deadline: Deadline = None,
+):
+    # Every pick takes the best of a random subset of the candidates left,
+    # so neither a heap nor the gains of every candidate are needed. Past
+    # the `deadline`, the subsets shrink to a single candidate.
+    if should_stop is None:
+        should_stop = _never_stop
+
+    place_order = df_place.place_id.to_numpy()
+    weights = df_place.weight.to_numpy()
+    if isinstance(d_visitor, dict):
+        d_visitor = VisitorMatrix.from_dict(d_visitor)
+    with instrumentation.span("greedy.subset"):
+        visitors = d_visitor.subset(place_order)
+    rng = np.random.default_rng(approx.seed)
+
+    id_candidate, lat_candidate, lon_candidate = maxheap_data
+    is_alive = np.ones(len(id_candidate), dtype=bool)
+    n_subset = int(
+        np.ceil(
+            len(id_candidate) / max(1, k - len(S)) * np.log(1 / approx.epsilon)
+        )
+    )
+
+    with instrumentation.span("greedy.objective"):
+        if approx.sample_size is None:
+            objective = _WindowObjective(visitors, weights, should_stop)
+        else:
+            objective = _SampledObjective(
+                visitors, weights, approx.sample_size, rng
+            )
+        for s in S:
+            objective.add(s)
+
+    with instrumentation.span("greedy.stochastic_loop"):
+        while len(S) < k and np.any(is_alive):
+            if should_stop():
+                raise SelectionCancelled
+
+            subset = np.flatnonzero(is_alive)
+            if deadline is not None and deadline.expired():
+                subset = rng.choice(subset, 1)
+            elif len(subset) > n_subset:
+                subset = rng.choice(subset, n_subset, replace=False)
+            instrumentation.count("greedy.evaluations", len(subset))
+
+            t = subset[np.argmax(objective.gains(id_candidate[subset]))]
+            objective.add(id_candidate[t])
+            S.append(id_candidate[t])
+
+            # same rule as `Maxheap.delete_neighbors`
+            is_alive &= ~(
+                distance_to_many(
+                    lat_candidate[t],
+                    lon_candidate[t],
+                    lat_candidate,
+                    lon_candidate,
+                    metric,
+                )
+                <= min_distance
+            )
+            is_alive[t] = False
 
     return S
 
 
-def calc_initial_score_Suo(
+class _WindowObjective:
+    """Gains over every place of the window, as `greedy_sos` computes them"""
+
+    def __init__(self, visitors, weights, should_stop=None):
+        self.visitors = visitors
+        self.weights = weights
+        self.should_stop = should_stop
+        self.sim_oS = np.zeros(len(visitors))
+
+    def gains(self, place_ids) -> np.ndarray:
+        return calc_initial_gain(
+            self.sim_oS,
+            place_ids,
+            self.visitors,
+            self.weights,
+            should_stop=self.should_stop,
+        )
+
+    def add(self, place_id) -> None:
+        update_sim_oS(self.sim_oS, place_id, self.visitors)
+
+
+class _SampledObjective:
+    """Gains estimated from `sample_size` places of the window drawn with
+    probability w_p / W: 1/|O| sum_p w_p f(p) ~ W / (|O| m) sum_draws f(p)"""
+
+    def __init__(self, visitors, weights, sample_size, rng):
+        total = float(np.sum(weights))
+        p = weights / total if total > 0 else None
+        draws = rng.choice(len(weights), sample_size, p=p)
+        rows, counts = np.unique(draws, return_counts=True)
+
+        self.visitors = visitors
+        self.sample = visitors.subset(visitors.place_id[rows])
+        self.scale = counts * total / sample_size / len(weights)
+        self.sim_pS = np.zeros(len(rows))
+
+    def gains(self, place_ids) -> np.ndarray:
+        sim = self.visitors.jaccard_against(
+            self.visitors.rows(place_ids), self.sample
+        )
+        value = self.scale[sim.indices] * np.maximum(
+            0, sim.data - self.sim_pS[sim.indices]
+        )
+        row = np.repeat(np.arange(sim.shape[0]), np.diff(sim.indptr))
+        return np.bincount(row, value, minlength=sim.shape[0])
+
+    def add(self, place_id) -> None:
+        sim = self.visitors.jaccard_against(
+            self.visitors.rows(place_id), self.sample
+        )
+        self.sim_pS[sim.indices] = np.maximum(
+            self.sim_pS[sim.indices], sim.data
+        )
+
+
+def calc_initial_gain(
     sim_oS,
     maxheap_place_id,
-    place_id_order,
-    d_visitor,
+    visitors,
     weights,
+    chunk_size=None,
+    n_workers=None,
+    deadline: Deadline = None,
+    should_stop=None,
 ):
-    sim_OSuo = [
-        calc_score_OS(
-            weights,
-            update_sim_oS(
-                sim_oS,
-                o,
-                place_id_order,
-                d_visitor,
-            ),
-        )
-        for o in maxheap_place_id
-    ]
+    # Score(S u o|O) - Score(S|O) = 1/|O| sum_p w_p max(0, sim(p, o) - sim(p, S))
+    # for a block of candidates at once. Only the neighbours p of o, which
+    # share a visitor with o, contribute. Every gain only sums its own row,
+    # so any blocking and worker count gives the same gains as the serial
+    # loop. Blocks starting past the `deadline` only get the term of p = o,
+    # sim(o, o) = 1. `should_stop()` is polled before every block.
+    if should_stop is None:
+        should_stop = _never_stop
+    if n_workers is None:
+        n_workers = N_WORKERS
+
+    candidate_rows = visitors.rows(maxheap_place_id)
+    if chunk_size is None:
+        degree = max(1, visitors.max_similar_pairs() // max(1, len(visitors)))
+        chunk_size = max(1, CHUNK_ELEMENTS // degree)
+        if n_workers > 1:
+            n_blocks = BLOCKS_PER_WORKER * n_workers
+            chunk_size = max(
+                1, min(chunk_size, -(-len(candidate_rows) // n_blocks))
+            )
+    gain = np.empty(len(candidate_rows))
+
+    def gain_block(start):
+        rows = candidate_rows[start : start + chunk_size]
+        if should_stop():
+            raise SelectionCancelled
+        if deadline is not None and deadline.expired():
+            gain[start : start + chunk_size] = (
+                weights[rows] * np.maximum(0, 1 - sim_oS[rows]) / len(weights)
+            )
+            return
 
-    return np.array(sim_OSuo)
+        block = visitors.neighbor_block(rows)
+        value = weights[block.indices] * np.maximum(
+            0, block.data - sim_oS[block.indices]
+        )
+        row = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+        gain[start : start + chunk_size] = np.bincount(
+            row, value, minlength=block.shape[0]
+        ) / len(weights)
+
+    starts = range(0, len(candidate_rows), chunk_size)
+    if n_workers <= 1 or len(starts) <= 1:
+        for start in starts:
+            gain_block(start)
+    else:
+        # sparse slicing and NumPy kernels release the GIL
+        list(_thread_pool(n_workers).map(gain_block, starts))
+
+    return gain
+
+
+def _thread_pool(n_workers: int) -> ThreadPoolExecutor:
+    if n_workers not in _thread_pools:
+        _thread_pools[n_workers] = ThreadPoolExecutor(
+            n_workers, thread_name_prefix="sos-gain"
+        )
+    return _thread_pools[n_workers]
 
 
 def calc_score_OS(weights, oS):
     return (1 / len(weights)) * np.dot(weights, oS)
 
 
-def update_sim_oS(old_oS, new_place_id, place_id_order, d_visitor):
-    new_oS = calc_sim_oS(new_place_id, place_id_order, d_visitor)
-    return np.max(np.stack([old_oS, new_oS]), axis=0)
+def calc_gain(sim_oS, place_id, visitors, weights):
+    # Score(S u o|O) - Score(S|O) for o = `place_id`, over its neighbours
+    col, sim = visitors.neighbors(visitors.rows(place_id)[0])
+    return np.dot(weights[col], np.maximum(0, sim - sim_oS[col])) / len(
+        weights
+    )
 
 
-def calc_sim_oS(new_place_id, place_id_order, d_visitor):
-    new_visitor = d_visitor[new_place_id]
-    oS = np.array([jaccard(d_visitor[o], new_visitor) for o in place_id_order])
-    return oS
+def update_sim_oS(sim_oS, new_place_id, visitors):
+    # sim(o, S u {new}) from sim(o, S), in place on the neighbours of `new`
+    col, sim = visitors.neighbors(visitors.rows(new_place_id)[0])
+    sim_oS[col] = np.maximum(sim_oS[col], sim)
+    return sim_oS
 
 
 # if __name__ == "__main__":
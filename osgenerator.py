@@ -1,9 +1,19 @@
-from metrics import jaccard, overlap_coeff
+from datastore import (
+    load_arrays,
+    open_store,
+    save_arrays,
+    update_store,
+)
+from csr_index import CSRIndex
+from ingest import read_tables
+import instrumentation
 from copy import deepcopy
+import os
 
 import pandas as pd
 import numpy as np
 import re
+from scipy import sparse
 
 
 def aggregate_to_list(df, key_col, value_col) -> pd.Series:
@@ -91,13 +101,21 @@ class OSGenerator:
         self.df_places = None
         self.df_countries = None
 
+        # offset indexes over the tables, see `build_index`
+        self.friend_index = None  # user_id -> friend_id
+        self.checkin_index = None  # user_id -> checkin row
+        self.visitor_index = None  # place_id -> user_id
+        self.place_index = None  # place_id -> place row
+        self.friend_matrix = None  # closed friend neighbourhoods, see below
+        self.friend_matrix_user = None  # user_id of each row/column
+
     @property
     def n_user(self):
-        return len(np.unique(self.df_friends["user_id"]))
+        return len(self.friend_index)
 
     @property
     def n_place(self):
-        return len(np.unique(self.df_places["place_id"]))
+        return len(self.place_index)
 
     @property
     def n_checkin(self):
@@ -110,6 +128,7 @@ class OSGenerator:
         self.df_checkins = df_checkin
         self.df_places = df_place
         self.df_countries = df_country
+        self.build_index()
 
     def read_from_file(
         self,
@@ -118,11 +137,172 @@ class OSGenerator:
         filepath_to_places: str,
         filepath_to_countries: str,
     ) -> None:
-        self.df_friends = pd.read_csv(filepath_to_friends)
-        self.df_checkins = pd.read_csv(filepath_to_checkins)
-        self.df_places = pd.read_csv(filepath_to_places)
-        self.df_countries = pd.read_csv(filepath_to_countries)
+        tables, _ = read_tables(
+            {
+                "friends": filepath_to_friends,
+                "checkins": filepath_to_checkins,
+                "places": filepath_to_places,
+                "countries": filepath_to_countries,
+            }
+        )
+        self.df_friends = tables["friends"]
+        self.df_checkins = tables["checkins"]
+        self.df_places = tables["places"]
+        self.df_countries = tables["countries"]
+        self.build_index()
 
+    def read_from_store(
+        self,
+        store_dir: str,
+        filepath_to_friends: str = None,
+        filepath_to_checkins: str = None,
+        filepath_to_places: str = None,
+        filepath_to_countries: str = None,
+    ) -> None:
+        # (re)builds the store when the given CSVs differ from its sources
+        csv_paths = {
+            "friends": filepath_to_friends,
+            "checkins": filepath_to_checkins,
+            "places": filepath_to_places,
+            "countries": filepath_to_countries,
+        }
+        csv_paths = {k: v for k, v in csv_paths.items() if v is not None}
+        if csv_paths:
+            update_store(csv_paths, store_dir)
+
+        tables = open_store(store_dir)
+        self.df_friends = tables["friends"]
+        self.df_checkins = tables["checkins"]
+        self.df_places = tables["places"]
+        self.df_countries = tables["countries"]
+
+        # the first process builds the indexes, the others map its copy
+        if not self.load_index(store_dir):
+            self.build_index()
+            if os.access(store_dir, os.W_OK):
+                self.save_index(store_dir)
+
+    @instrumentation.timed("osgen.build_index")
+    def build_index(self) -> None:
+        self.friend_index = CSRIndex(
+            self.df_friends["user_id"].to_numpy(),
+            self.df_friends["friend_id"].to_numpy(),
+            unique=True,
+        )
+        self.checkin_index = CSRIndex(self.df_checkins["user_id"].to_numpy())
+        self.visitor_index = CSRIndex(
+            self.df_checkins["place_id"].to_numpy(),
+            self.df_checkins["user_id"].to_numpy(),
+            unique=True,
+        )
+        self.place_index = CSRIndex(self.df_places["place_id"].to_numpy())
+        self.build_friend_matrix()
+
+    INDEXES = ["friend_index", "checkin_index", "visitor_index", "place_index"]
+
+    def save_index(self, store_dir: str) -> None:
+        arrays = {
+            "friend_matrix.data": self.friend_matrix.data,
+            "friend_matrix.indices": self.friend_matrix.indices,
+            "friend_matrix.indptr": self.friend_matrix.indptr,
+            "friend_matrix.user": self.friend_matrix_user,
+        }
+        for name in self.INDEXES:
+            index = getattr(self, name)
+            arrays[f"{name}.keys"] = index.keys
+            arrays[f"{name}.indptr"] = index.indptr
+            arrays[f"{name}.values"] = index.values
+        save_arrays(os.path.join(store_dir, "index"), arrays)
+
+    @instrumentation.timed("osgen.load_index")
+    def load_index(self, store_dir: str) -> bool:
+        """Memory-maps the indexes `save_index` stored, read-only"""
+        arrays = load_arrays(os.path.join(store_dir, "index"))
+        if arrays is None:
+            return False
+
+        for name in self.INDEXES:
+            setattr(
+                self,
+                name,
+                CSRIndex.from_arrays(
+                    arrays[f"{name}.keys"],
+                    arrays[f"{name}.indptr"],
+                    arrays[f"{name}.values"],
+                ),
+            )
+        self.friend_matrix_user = arrays["friend_matrix.user"]
+        n = len(self.friend_matrix_user)
+        self.friend_matrix = sparse.csr_matrix(
+            (
+                arrays["friend_matrix.data"],
+                arrays["friend_matrix.indices"],
+                arrays["friend_matrix.indptr"],
+            ),
+            shape=(n, n),
+            copy=False,
+        )
+        return True
+
+    def build_friend_matrix(self) -> None:
+        # row u holds N(u) u {u}; users only seen as friends get a row too
+        index = self.friend_index
+        self.friend_matrix_user = np.union1d(index.keys, index.values)
+        n = len(self.friend_matrix_user)
+
+        rows = np.concatenate(
+            [
+                np.repeat(
+                    self._friend_matrix_pos(index.keys), np.diff(index.indptr)
+                ),
+                np.arange(n),
+            ]
+        )
+        cols = np.concatenate(
+            [self._friend_matrix_pos(index.values), np.arange(n)]
+        )
+        self.friend_matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(n, n)
+        )
+        self.friend_matrix.sum_duplicates()
+        self.friend_matrix.data[:] = 1
+
+    def _friend_matrix_pos(self, user) -> np.ndarray:
+        return np.searchsorted(self.friend_matrix_user, user)
+
+    def _friend_similarity(self, user, friend) -> np.ndarray:
+        """Jaccard of N(user) u {user} and N(friend) u {friend}, pairwise"""
+        # |intersection| counts the columns of friend row i also found in
+        # the row of user[i]; the row of a user is read once, however many
+        # of the pairs it is in, as (row, column) keys to search
+        n = self.friend_matrix.shape[1]
+        user_pos = self._friend_matrix_pos(user).astype(np.int64)
+        if len(user_pos) == 0:
+            return np.empty(0)
+        m_friend = self.friend_matrix[self._friend_matrix_pos(friend)]
+
+        distinct_pos = np.unique(user_pos)
+        m_user = self.friend_matrix[distinct_pos].tocoo()
+        user_keys = np.sort(distinct_pos[m_user.row] * n + m_user.col)
+
+        pair = np.repeat(np.arange(len(user_pos)), np.diff(m_friend.indptr))
+        pair_keys = user_pos[pair] * n + m_friend.indices
+        at = np.minimum(
+            np.searchsorted(user_keys, pair_keys), len(user_keys) - 1
+        )
+        is_shared = user_keys[at] == pair_keys
+        n_intersect = np.bincount(pair[is_shared], minlength=len(user_pos))
+
+        # sizes of the friend lists plus the user themselves
+        n_union = (
+            self.friend_index.degree(user)
+            + self.friend_index.degree(friend)
+            + 2
+            - n_intersect
+        )
+        return n_intersect / n_union
+
+    @instrumentation.timed("osgen.get_user_friend")
     def get_user_friend(self, user) -> pd.Series:  # ok
         if isinstance(user, int):
             user = [user]
@@ -131,30 +311,30 @@ class OSGenerator:
         else:
             user = list(set(user))
 
-        is_user_exist_list = pd.Series(user).isin(self.df_friends["user_id"])
+        is_user_exist_list = self.friend_index.contains(user)
         if not all(is_user_exist_list):
             failed_idx = is_user_exist_list.argmin()
             raise ValueError(f"User {user[failed_idx]} doesn't exist")
 
-        df_filtered = self.df_friends[self.df_friends["user_id"].isin(user)]
-        keys, values = aggregate_to_list(df_filtered, "user_id", "friend_id")
-        return pd.Series(values, keys)
+        keys = np.unique(user)
+        values = [self.friend_index.get(key).tolist() for key in keys]
+        return pd.Series(values, keys, dtype=object)
 
+    @instrumentation.timed("osgen.get_user_relevant_friend")
     def get_user_relevant_friend(self, user: int) -> pd.DataFrame:
-        user_friend = self.get_user_friend(user)[user]
-        friend_of_user_friend = self.get_user_friend(user_friend)
+        if not self.friend_index.contains(user)[0]:
+            raise ValueError(f"User {user} doesn't exist")
 
-        similarity_scores = []
-        similarity_id = []
-        for f in friend_of_user_friend.items():
-            j_val = jaccard(user_friend + [user], f[1] + [f[0]])
-            similarity_scores.append(j_val)
-            similarity_id.append(f[0])
+        user_friend = self.friend_index.get(user)
+        similarity_scores = self._friend_similarity(
+            np.full(len(user_friend), user), user_friend
+        )
+        similarity_id = user_friend
 
         idx_shuffle = np.arange(len(similarity_id))
         np.random.shuffle(idx_shuffle)
-        similarity_scores = np.array(similarity_scores)[idx_shuffle]
-        similarity_id = np.array(similarity_id)[idx_shuffle]
+        similarity_scores = similarity_scores[idx_shuffle]
+        similarity_id = similarity_id[idx_shuffle]
 
         n_selected = int((len(user_friend) + 0.5) ** (1 / 3))
         selected_index = np.argsort(similarity_scores)[-n_selected:]
@@ -171,6 +351,41 @@ class OSGenerator:
 
         return df_friend
 
+    @instrumentation.timed("osgen.get_users_relevant_friend")
+    def get_users_relevant_friend(self, users: list) -> pd.DataFrame:
+        """Batch version of `get_user_relevant_friend` for many users, with
+        one sparse row product over all (user, friend) pairs"""
+        users = np.unique(users)
+        is_user_exist_list = self.friend_index.contains(users)
+        if not all(is_user_exist_list):
+            failed_idx = is_user_exist_list.argmin()
+            raise ValueError(f"User {users[failed_idx]} doesn't exist")
+
+        n_friend = self.friend_index.degree(users)
+        pair_user = np.repeat(users, n_friend)
+        pair_friend = self.friend_index.get_many(users)
+        pair_score = self._friend_similarity(pair_user, pair_friend)
+
+        # rank friends per user by score, ties broken at random
+        order = np.lexsort(
+            (np.random.random(len(pair_score)), -pair_score, pair_user)
+        )
+        group_start = np.repeat(np.cumsum(n_friend) - n_friend, n_friend)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - group_start
+
+        n_selected = ((n_friend + 0.5) ** (1 / 3)).astype(np.int64)
+        is_selected = rank < np.repeat(n_selected, n_friend)
+        selected = order[is_selected[order]]  # by user, best score first
+
+        df_friend = pd.DataFrame()
+        df_friend["user_id"] = pair_user[selected]
+        df_friend["friend_id"] = pair_friend[selected]
+        df_friend["similarity"] = pair_score[selected]
+
+        return df_friend
+
+    @instrumentation.timed("osgen.get_visitor")
     def get_visitor(self, placeid):
         if isinstance(placeid, int):
             placeid = [placeid]
@@ -179,33 +394,51 @@ class OSGenerator:
         else:
             placeid = list(set(placeid))
 
-        is_place_exist = pd.Series(placeid).isin(self.df_places["place_id"])
+        is_place_exist = self.place_index.contains(placeid)
         if not all(is_place_exist):
             failed_idx = is_place_exist.argmin()
             raise KeyError(f"User {placeid[failed_idx]} doesn't exist")
 
-        df_filtered = self.df_checkins[
-            self.df_checkins["place_id"].isin(placeid)
-        ]
-        keys, values = aggregate_to_list(df_filtered, "place_id", "user_id")
-        return pd.Series(values, keys)
+        keys = np.unique(placeid)
+        keys = keys[self.visitor_index.contains(keys)]  # checked-in places
+        values = [self.visitor_index.get(key).tolist() for key in keys]
+        return pd.Series(values, keys, dtype=object)
 
+    @instrumentation.timed("osgen.get_checkin_time")
     def get_checkin_time(self, user: int, placeid: int):  # ok
-        return self.df_checkins[
-            (self.df_checkins["user_id"] == user)
-            & (self.df_checkins["place_id"] == placeid)
-        ]
+        rows = self.checkin_index.get(user)
+        rows = rows[self.df_checkins["place_id"].to_numpy()[rows] == placeid]
+        return self._checkins_at(rows)
 
+    @instrumentation.timed("osgen.get_user_checkin")
     def get_user_checkin(self, user):  # ok
-        if isinstance(user, int):
-            return self.df_checkins[self.df_checkins["user_id"] == user]
-        elif isinstance(user, list):
-            return self.df_checkins[self.df_checkins["user_id"].isin(user)]
+        rows = self._checkin_rows(user)
+        if rows is not None:
+            return self._checkins_at(rows)
 
+    @instrumentation.timed("osgen.get_user_place")
     def get_user_place(self, user):
-        places = self.get_user_checkin(user)["place_id"].tolist()
-        return self.df_places[self.df_places["place_id"].isin(places)]
+        rows = self._checkin_rows(user)
+        places = self.df_checkins["place_id"].to_numpy()[rows]
+        rows = self.place_index.get_many(np.unique(places))
+        return self.df_places.iloc[np.sort(rows)]
+
+    def _checkin_rows(self, user):
+        if isinstance(user, int):
+            return self.checkin_index.get(user)
+        elif isinstance(user, list):
+            return np.sort(self.checkin_index.get_many(np.unique(user)))
+
+    def _checkins_at(self, rows) -> pd.DataFrame:
+        df_checkin = self.df_checkins.iloc[rows]
+        if np.issubdtype(df_checkin["datetime"].dtype, np.integer):
+            # stored as seconds since the epoch, see `ingest`
+            df_checkin = df_checkin.assign(
+                datetime=pd.to_datetime(df_checkin["datetime"], unit="s")
+            )
+        return df_checkin
 
+    @instrumentation.timed("osgen.get_relevant_place")
     def get_relevant_place(self, user, with_visitor=False):
         df_direct_visit = deepcopy(self.get_user_place(user))
         df_direct_visit["is_direct"] = [1] * len(df_direct_visit)
@@ -242,9 +475,11 @@ class OSGenerator:
         else:
             return df_places
 
+    @instrumentation.timed("osgen.get_place_info")
     def get_place_info(self, placeid: int):  # ok
-        return self.df_places[self.df_places["place_id"] == placeid]
+        return self.df_places.iloc[self.place_index.get(placeid)]
 
+    @instrumentation.timed("osgen.get_object_summary")
     def get_object_summary(self, user: int):
         df_user = pd.DataFrame([user], columns=["user_id"])
         df_friend = self.get_user_relevant_friend(user)
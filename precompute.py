@@ -0,0 +1,148 @@
+"""
+precompute.py: Offline batch computation of relevant places per user
+
+For every requested user, runs `get_relevant_place` and
+`get_object_summary` across a process pool and writes the places, their
+weights and the visitor lists (CSR) to `<store>/relevant/`. `load_os` serves
+these files and falls back to live computation when a user is missing.
+Results live inside the dataset store, so rebuilding the store drops them.
+
+Usage:
+    python precompute.py --users 1000 2 --workers 4
+    python precompute.py --all --workers 1 2 4 8   (throughput per count)
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from osgenerator import OSGenerator
+from visitor_matrix import VisitorMatrix
+
+_osgen = None  # one per worker process, see `_init_worker`
+
+
+def relevant_path(store_dir: str, user: int) -> str:
+    return os.path.join(
+        store_dir, "relevant", f"{user % 1000:03d}", f"{user}.npz"
+    )
+
+
+def compute_relevant(osgen: OSGenerator, user: int):
+    np.random.seed(user)  # reproducible tie-shuffling of friends
+    df_places, d_visitor = osgen.get_relevant_place(user, True)
+    os_string = str(osgen.get_object_summary(user))
+
+    return df_places, d_visitor, os_string
+
+
+def save_relevant(store_dir, user, df_places, d_visitor, os_string) -> None:
+    visitors = [d_visitor[pid] for pid in df_places["place_id"]]
+    indptr = np.concatenate([[0], np.cumsum([len(v) for v in visitors])])
+    visitor_id = np.fromiter(
+        (uid for v in visitors for uid in v), dtype=np.int64, count=indptr[-1]
+    )
+
+    filepath = relevant_path(store_dir, user)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath + ".tmp", "wb") as f:
+        np.savez(
+            f,
+            columns=np.array(df_places.columns, dtype=np.str_),
+            visitor_indptr=indptr,
+            visitor_id=visitor_id,
+            os_string=np.array(os_string),
+            **{f"col_{col}": df_places[col].to_numpy() for col in df_places},
+        )
+    os.replace(filepath + ".tmp", filepath)
+
+
+def load_relevant(store_dir: str, user: int):
+    """Returns (df_places, VisitorMatrix, os_string), or None when `user`
+    was not precomputed"""
+    filepath = relevant_path(store_dir, user)
+    if not os.path.exists(filepath):
+        return None
+
+    with np.load(filepath) as npz:
+        df_places = pd.DataFrame(
+            {col: npz[f"col_{col}"] for col in npz["columns"]}
+        )
+        indptr, visitor_id = npz["visitor_indptr"], npz["visitor_id"]
+        os_string = str(npz["os_string"])
+
+    visitors = VisitorMatrix(df_places["place_id"], indptr, visitor_id)
+    return df_places, visitors, os_string
+
+
+def _init_worker(store_dir: str) -> None:
+    global _osgen
+    _osgen = OSGenerator()
+    _osgen.read_from_store(store_dir)
+
+
+def _precompute_user(args):
+    store_dir, user = args
+    start = perf_counter()
+    df_places, d_visitor, os_string = compute_relevant(_osgen, user)
+    save_relevant(store_dir, user, df_places, d_visitor, os_string)
+    return user, len(df_places), perf_counter() - start
+
+
+def precompute(store_dir: str, users: list, n_workers: int) -> dict:
+    start = perf_counter()
+    with ProcessPoolExecutor(
+        n_workers, initializer=_init_worker, initargs=(store_dir,)
+    ) as executor:
+        results = list(
+            executor.map(
+                _precompute_user,
+                [(store_dir, int(user)) for user in users],
+                chunksize=max(1, len(users) // (16 * n_workers)),
+            )
+        )
+    elapsed = perf_counter() - start
+
+    return {
+        "n_workers": n_workers,
+        "n_users": len(results),
+        "n_places": sum(n for _, n, _ in results),
+        "seconds": elapsed,
+        "users_per_second": len(results) / elapsed if elapsed > 0 else 0.0,
+        "ms_per_user": 1e3 * np.mean([t for _, _, t in results]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--store", default="data/store")
+    parser.add_argument("--users", type=int, nargs="*", default=[])
+    parser.add_argument("--all", action="store_true", help="every user")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1])
+    args = parser.parse_args()
+
+    users = args.users
+    if args.all:
+        osgen = OSGenerator()
+        osgen.read_from_store(args.store)
+        users = osgen.friend_index.keys.tolist()
+        del osgen
+
+    header = ["workers", "users", "places", "seconds", "users/s", "ms/user"]
+    print(" ".join(f"{h:>9}" for h in header))
+    for n_workers in args.workers:
+        report = precompute(args.store, users, n_workers)
+        print(
+            f"{report['n_workers']:>9} {report['n_users']:>9} "
+            f"{report['n_places']:>9} {report['seconds']:>9.2f} "
+            f"{report['users_per_second']:>9.1f} "
+            f"{report['ms_per_user']:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+prefetch.py: Speculative selections of the next viewports
+
+Once a selection is shown, `prefetch` runs `isos` for the viewports of
+`viewport.adjacent_viewports`, from the bounds and D/G just returned to the
+browser, exactly what the next request would pass. Results are kept per
+session in the shared diskcache, keyed by the quantized viewport and a hash
+of that seed, so a request only hits when it continues from the same
+selection, as far as `isos` can tell (see `seed_key`).
+"""
+
+import hashlib
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+from object_selection import isos
+from viewport import adjacent_viewports, move_kind, quantize_bounds
+
+
+def seed_key(session, prev_bounds: list, bounds: list, D: list, G: list):
+    """Hash of the selection a request for `bounds` starts from, as `isos`
+    sees it: the kind of move from `prev_bounds` and the places of D and G
+    it keeps in the viewport, so requests from other bounds can share it"""
+    move = move_kind(prev_bounds, bounds)
+    [lat1, lon1], [lat2, lon2] = bounds
+    window_idx = session.index.query_bbox(lat1, lon1, lat2, lon2)
+    window = session.df_places["place_id"].to_numpy()[window_idx]
+
+    # D keeps its order, the order S is returned in, G is a set
+    D = np.asarray(D, dtype=np.int64)
+    G = np.asarray(G, dtype=np.int64)
+    kept_D = [] if move == "zoom_out" else D[np.isin(D, window)].tolist()
+    kept_G = [] if move == "zoom_in" else np.intersect1d(G, window).tolist()
+
+    seed = json.dumps([move, kept_D, kept_G])
+    return hashlib.sha1(seed.encode()).hexdigest()
+
+
+class PrefetchCache:
+    """Bounded {(quantized bounds, seed): (bounds, S, G)} per session"""
+
+    def __init__(self, cache, max_entries: int = 32, expire: float = 3600):
+        self.cache = cache
+        self.max_entries = max_entries
+        self.expire = expire
+
+    def get(self, session_key: str, bounds: list, seed: str):
+        entries = self.cache.get(f"prefetch:{session_key}")
+        if entries is None:
+            return None
+        return entries.get((quantize_bounds(bounds), seed))
+
+    def put(self, session_key: str, bounds: list, seed: str, S, G) -> None:
+        key = f"prefetch:{session_key}"
+        with self.cache.transact():
+            entries = self.cache.get(key) or OrderedDict()
+            entries[(quantize_bounds(bounds), seed)] = (
+                bounds,
+                [int(s) for s in S],
+                [int(g) for g in G],
+            )
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self.cache.set(key, entries, expire=self.expire)
+
+
+def prefetch(
+    prefetched: PrefetchCache,
+    session_key: str,
+    session,  # PlaceSession
+    bounds: list,
+    D: list,
+    G: list,
+    k: int = 10,
+    state=None,
+    pyramid=None,
+    should_stop=None,
+) -> int:
+    """Selects the viewports adjacent to `bounds` after a request returned
+    `D` and `G` for it. Returns the number of new entries."""
+    n_prefetched = 0
+    for view in adjacent_viewports(bounds).values():
+        seed = seed_key(session, bounds, view, D, G)
+        if prefetched.get(session_key, view, seed) is not None:
+            continue
+
+        new_S, new_G = isos(
+            session.df_places,
+            session.visitors,
+            bounds,
+            view,
+            k,
+            list(D),
+            list(G),
+            index=session.index,
+            state=state,
+            pyramid=pyramid,
+            should_stop=should_stop,
+        )
+        prefetched.put(session_key, view, seed, new_S, new_G)
+        n_prefetched += 1
+    return n_prefetched
@@ -0,0 +1,191 @@
+"""
+pyramid.py: Multi-resolution tile pyramid of diversified selections
+
+Zoom level z splits the world into 2^z x 2^z tiles of 180/2^z degrees of
+latitude by 360/2^z degrees of longitude. Each tile stores the top-k
+selection `greedy_sos` makes over its places with a separation distance of
+10% of the tile height measured with `metric`, as `isos` does for a
+viewport. A tile holding more than `leaf_size` places only considers the
+selections of its four children as candidates, so building coarse tiles
+stays cheap. Built tiles are cached.
+
+A viewport is answered from the tiles one level below the one whose tiles
+are at least as tall as the viewport, i.e. 4 to 9 tiles, see
+`isos(pyramid=...)`. Requests only read tiles: `build` makes those of a
+viewport, which the app does in the background after answering it.
+"""
+
+import numpy as np
+import pandas as pd
+
+from metrics import get_metric
+from spatial_index import SpatialIndex
+from visitor_matrix import VisitorMatrix
+
+
+class SelectionPyramid:
+    """Only the tiles are kept here; the places, their visitors and their
+    index are passed to every call, like `SelectionState`."""
+
+    def __init__(
+        self,
+        k: int = 10,
+        leaf_size: int = 2000,
+        max_zoom=18,
+        metric="planar",
+    ):
+        self.k = k
+        self.metric = metric
+        self.leaf_size = leaf_size
+        self.max_zoom = max_zoom
+        self.tiles = {}  # (z, x, y) -> selected place_id
+
+    @staticmethod
+    def tile_bounds(z: int, x: int, y: int) -> list:
+        height, width = 180 / 2**z, 360 / 2**z
+        lat1, lon1 = -90 + y * height, -180 + x * width
+        return [[lat1, lon1], [lat1 + height, lon1 + width]]
+
+    def zoom_for(self, bounds: list) -> int:
+        [lat1, _], [lat2, _] = bounds
+        height = max(lat2 - lat1, 1e-9)
+        z = int(np.floor(np.log2(180 / height)))
+        return min(max(z, 0), self.max_zoom)
+
+    def tiles_for(self, bounds: list) -> list:
+        [lat1, lon1], [lat2, lon2] = bounds
+        z = min(self.zoom_for(bounds) + 1, self.max_zoom)
+        n = 2**z
+
+        def tile_range(low, high, origin, size):
+            first = int(np.floor((low - origin) / size))
+            last = int(np.floor((high - origin) / size))
+            return range(max(first, 0), min(last, n - 1) + 1)
+
+        return [
+            (z, x, y)
+            for y in tile_range(lat1, lat2, -90, 180 / n)
+            for x in tile_range(lon1, lon2, -180, 360 / n)
+        ]
+
+    def tile(
+        self,
+        df_place: pd.DataFrame,
+        visitors: VisitorMatrix,
+        index: SpatialIndex,
+        z: int,
+        x: int,
+        y: int,
+        should_stop=None,
+        deadline=None,
+    ) -> np.ndarray:
+        # Past the `deadline`, tiles are no longer built: an unbuilt tile
+        # stands for the selections of its descendants built so far, and is
+        # left for a later call to complete.
+        key = (z, x, y)
+        if key in self.tiles:
+            return self.tiles[key]
+        if deadline is not None and deadline.expired():
+            return self._built_below(z, x, y)
+
+        from object_selection import greedy_sos
+
+        [lat1, lon1], [lat2, lon2] = self.tile_bounds(z, x, y)
+        tile_pos = index.query_bbox(lat1, lon1, lat2, lon2)
+        df_tile = df_place.iloc[tile_pos]
+
+        if len(df_tile) <= self.leaf_size or z >= self.max_zoom:
+            candidate_pos = tile_pos
+        else:
+            child_selection = np.concatenate(
+                [
+                    self.tile(
+                        df_place,
+                        visitors,
+                        index,
+                        z + 1,
+                        cx,
+                        cy,
+                        should_stop,
+                        deadline,
+                    )
+                    for cx in [2 * x, 2 * x + 1]
+                    for cy in [2 * y, 2 * y + 1]
+                ]
+            )
+            if deadline is not None and deadline.expired():
+                return child_selection
+            candidate_pos = tile_pos[
+                df_tile["place_id"].isin(child_selection).to_numpy()
+            ]
+        df_candidate = df_place.iloc[candidate_pos]
+
+        selection = []
+        if len(df_tile) > 0:
+            selection = greedy_sos(
+                [
+                    df_candidate["place_id"].to_numpy(),
+                    df_candidate["lat"].to_numpy(),
+                    df_candidate["lon"].to_numpy(),
+                ],
+                df_tile,
+                visitors,
+                self.k,
+                get_metric(self.metric)(lat1, lon1, lat2, lon1) * 0.1,
+                [],
+                metric=self.metric,
+                should_stop=should_stop,
+                deadline=deadline,
+                index=index,
+                index_pos=candidate_pos,
+            )
+            if deadline is not None and deadline.missed:
+                return np.array(selection, dtype=np.int64)
+
+        self.tiles[key] = np.array(selection, dtype=np.int64)
+        return self.tiles[key]
+
+    def _built_below(self, z: int, x: int, y: int) -> np.ndarray:
+        selections = [
+            selection
+            for (cz, cx, cy), selection in self.tiles.items()
+            if cz > z and cx >> (cz - z) == x and cy >> (cz - z) == y
+        ]
+        if len(selections) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(selections)
+
+    def build(
+        self,
+        df_place: pd.DataFrame,
+        visitors: VisitorMatrix,
+        index: SpatialIndex,
+        bounds: list,
+        should_stop=None,
+        deadline=None,
+    ) -> bool:
+        """Builds the tiles `candidates` reads for `bounds`, as far as the
+        `deadline` allows. Returns whether all of them are built."""
+        for key in self.tiles_for(bounds):
+            self.tile(df_place, visitors, index, *key, should_stop, deadline)
+        return all(key in self.tiles for key in self.tiles_for(bounds))
+
+    def candidates(self, bounds: list) -> np.ndarray:
+        """Merged selections of the tiles overlapping `bounds`, None unless
+        all of them are built"""
+        keys = self.tiles_for(bounds)
+        if not all(key in self.tiles for key in keys):
+            return None
+        if len(keys) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate([self.tiles[key] for key in keys]))
+
+    def saturated(self, bounds: list) -> bool:
+        """Whether every built tile overlapping `bounds` selected fewer than
+        `k` places, i.e. all its separation distance allows. The tiles are
+        no taller than the viewport, whose separation distance is no
+        smaller, so their selections are all the viewport can hold."""
+        return all(
+            len(self.tiles.get(key, [])) < self.k
+            for key in self.tiles_for(bounds)
+        )
@@ -0,0 +1,84 @@
+"""
+result_cache.py: Selections shared across sessions and restarts
+
+`isos` only depends on the places of a user, the viewport, k and the selection
+it continues from, so its results are stored under (user, hash of their places,
+quantized viewport, k, `prefetch.seed_key`). The seed holds the kind of move
+and the D/G kept in the viewport rather than the previous bounds themselves.
+The entries live in their own diskcache directory next to the app cache, with
+least-recently-used eviction once `size_limit` bytes are reached, and are
+dropped when the dataset version (see `datastore.store_version`) changes. Hits
+and misses are counted by diskcache across processes, see `stats`.
+"""
+
+import os
+
+import diskcache
+
+from prefetch import seed_key
+from viewport import quantize_bounds
+
+
+class ResultCache:
+    def __init__(
+        self,
+        cache: diskcache.Cache,
+        version: str,
+        size_limit: int = 2**28,
+        subdir: str = "results",
+    ):
+        self.version = version
+        self.results = diskcache.Cache(
+            os.path.join(cache.directory, subdir),
+            size_limit=size_limit,
+            eviction_policy="least-recently-used",
+        )
+
+        # kept in the app cache, out of reach of the LRU of the results
+        with cache.transact():
+            if cache.get(f"{subdir}:dataset_version") != version:
+                self.results.clear()
+                cache.set(f"{subdir}:dataset_version", version)
+        self.results.stats(enable=True)
+
+    @staticmethod
+    def key(session, bounds: list, k: int, seed: str) -> tuple:
+        return (
+            int(session.user),
+            session.fingerprint,
+            quantize_bounds(bounds),
+            int(k),
+            seed,
+        )
+
+    def get(self, session, bounds: list, k: int, prev_bounds, D, G):
+        """(bounds, S, G) of the same request for the `PlaceSession`, or
+        None"""
+        return self.results.get(
+            self.key(
+                session,
+                bounds,
+                k,
+                seed_key(session, prev_bounds, bounds, D, G),
+            )
+        )
+
+    def put(self, session, bounds, k, prev_bounds, D, G, new_S, new_G):
+        self.results.set(
+            self.key(
+                session,
+                bounds,
+                k,
+                seed_key(session, prev_bounds, bounds, D, G),
+            ),
+            (bounds, [int(s) for s in new_S], [int(g) for g in new_G]),
+        )
+
+    def stats(self) -> dict:
+        hits, misses = self.results.stats()
+        return {
+            "hits": hits,
+            "misses": misses,
+            "entries": len(self.results),
+            "bytes": self.results.volume(),
+        }
@@ -0,0 +1,146 @@
+"""
+selection_state.py: iSOS state carried across the frames of one session
+
+`greedy_sos` needs, for the window O and the retained set S,
+    sim(p, S)  for every p in O
+    gain(o) = Score(S u o|O) - Score(S|O)
+            = 1/|O| * sum_{p in O} w_p * max(0, sim(p, o) - sim(p, S))
+for every candidate o. Only pairs sharing a visitor contribute to the sum,
+so after a pan or zoom the sums are corrected for the places that entered
+or left O and for the places whose sim(p, S) changed, instead of being
+recomputed over the whole window. When that change touches more places
+than there are candidates with a known sum, as after a long pan or once S
+is first filled, the sums of the candidates are recomputed instead and the
+others are forgotten until needed.
+"""
+
+import numpy as np
+
+import instrumentation
+from visitor_matrix import VisitorMatrix
+
+
+class SelectionState:
+    """Arrays are indexed by the row of each place in the visitor matrix of
+    the loaded user, which is passed to every call so the state itself stays
+    small enough to be stored per session."""
+
+    def __init__(self):
+        self.reset(0)
+
+    def reset(self, n: int) -> None:
+        self.in_window = np.zeros(n, dtype=bool)
+        self.weight = np.zeros(n)
+        self.sim_S = np.zeros(n)  # sim(p, S) the sums were computed with
+        self.gain_sum = np.zeros(n)  # |O| * gain(o)
+        self.known = np.zeros(n, dtype=bool)  # gain_sum is up to date
+
+    def prepare(
+        self, visitors: VisitorMatrix, window, weights, S, candidate_id
+    ):
+        """Moves the state to the window `window`, the subset of `visitors`
+        over O, and retained set `S`.
+
+        Returns sim(o, S) in the order of `window` and the gains of
+        `candidate_id`. Similarities are read from `window.neighbor_block`,
+        its similarity graph when built, except those of the places that
+        left the window, which are computed against the window only. The
+        cost thus follows the places that entered, left or changed, or the
+        candidates, whichever are fewer, and not the places of the user.
+        """
+        if len(self.in_window) != len(visitors):
+            self.reset(len(visitors))
+
+        rows = visitors.rows(window.place_id)
+        weights = np.asarray(weights, dtype=np.float64)
+        in_window = np.zeros(len(self.in_window), dtype=bool)
+        in_window[rows] = True
+
+        sim_S = np.zeros(len(window))  # in the order of `window`
+        for s in S:
+            col, sim = window.neighbors(window.rows(s)[0])
+            sim_S[col] = np.maximum(sim_S[col], sim)
+
+        was_in_window = self.in_window[rows]
+        entered = np.flatnonzero(~was_in_window)
+        kept = np.flatnonzero(was_in_window)
+        changed = kept[sim_S[kept] != self.sim_S[rows[kept]]]
+        left = np.flatnonzero(self.in_window & ~in_window)
+
+        candidates = window.rows(candidate_id)
+        known = np.zeros(len(window), dtype=bool)
+        known[kept] = self.known[rows[kept]]
+        n_delta = len(entered) + len(changed) + len(left)
+        is_incremental = n_delta < np.sum(known[candidates])
+
+        gain_sum = np.zeros(len(window))
+        if is_incremental:
+            # sum_p w_p * max(0, sim(p, o) - sim(p, S)) is symmetric in its
+            # use of sim, so the contribution of p to every o is read from
+            # row p
+            delta = self._contribution(
+                window.neighbor_block(entered),
+                weights[entered],
+                sim_S[entered],
+            )
+            delta += self._contribution(
+                window.neighbor_block(changed),
+                weights[changed],
+                sim_S[changed],
+                self.sim_S[rows[changed]],
+            )
+            if len(left) > 0:
+                delta -= self._contribution(
+                    visitors.jaccard_against(left, window),
+                    self.weight[left],
+                    self.sim_S[left],
+                )
+            gain_sum[known] = self.gain_sum[rows[known]] + delta[known]
+        else:
+            known[:] = False
+
+        unknown = candidates[~known[candidates]]
+        instrumentation.count(
+            "state.similarity_rows",
+            len(S) + len(unknown) + (n_delta if is_incremental else 0),
+        )
+        gain_sum[unknown] = self._gain_sum(
+            window.neighbor_block(unknown), weights, sim_S
+        )
+        known[unknown] = True
+
+        self.in_window[left] = False
+        self.known[left] = False
+        self.in_window[rows] = True
+        self.known[rows] = known
+        self.weight[rows] = weights
+        self.sim_S[left] = 0
+        self.sim_S[rows] = sim_S
+        self.gain_sum[rows] = gain_sum
+
+        return sim_S, gain_sum[candidates] / len(rows)
+
+    @staticmethod
+    def _contribution(block, weight_rows, sim_S_rows, sim_S_before=None):
+        """sum over the rows p of `block`, their similarities to every place
+        o of the window, of w_p * max(0, sim(p, o) - sim(p, S)), minus the
+        same with `sim_S_before` when given"""
+        row = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+        value = np.maximum(0, block.data - sim_S_rows[row])
+        if sim_S_before is not None:
+            value -= np.maximum(0, block.data - sim_S_before[row])
+        return np.bincount(
+            block.indices, weight_rows[row] * value, minlength=block.shape[1]
+        ).astype(np.float64)
+
+    @staticmethod
+    def _gain_sum(block, weights, sim_S) -> np.ndarray:
+        """sum over p in the window of w_p * max(0, sim(p, o) - sim(p, S)),
+        for every o of the rows of `block`"""
+        row = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+        value = weights[block.indices] * np.maximum(
+            0, block.data - sim_S[block.indices]
+        )
+        return np.bincount(row, value, minlength=block.shape[0]).astype(
+            np.float64
+        )
@@ -0,0 +1,79 @@
+"""
+session_store.py: Server-side state of a loaded user
+
+The browser only keeps a short session key. The typed places table, the
+visitor matrix and the spatial index of the loaded user stay on the server,
+in the shared `diskcache.Cache` so background callback processes see them.
+Every callback reading a session runs in a new process, so each read
+unpickles the session from the cache. Sessions hold no similarity graph, the
+greedy runs build the one of their window, and take about 3 MB at 20k places.
+The cache keeps 1 GB by default, shared with the results of the Dash jobs, and
+evicts the least recently stored entries beyond it.
+"""
+
+import hashlib
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+
+from spatial_index import SpatialIndex
+from visitor_matrix import VisitorMatrix
+
+PLACE_DTYPES = {
+    "place_id": int,
+    "lat": np.float32,
+    "lon": np.float32,
+    "country_id": int,
+    "is_direct": int,
+    "weight": np.float32,
+}
+
+
+class PlaceSession:
+    """Relevant places of one user, with the structures `isos` needs"""
+
+    def __init__(self, user: int, df_places: pd.DataFrame, d_visitor):
+        self.user = user
+        self.df_places = df_places.reset_index(drop=True).astype(PLACE_DTYPES)
+
+        # ties among friends can give a user other places in a new session
+        md5 = hashlib.md5(self.df_places["place_id"].to_numpy().tobytes())
+        md5.update(self.df_places["weight"].to_numpy().tobytes())
+        self.fingerprint = md5.hexdigest()
+
+        if isinstance(d_visitor, dict):
+            d_visitor = VisitorMatrix.from_dict(d_visitor)
+        self.visitors = d_visitor
+        self.index = SpatialIndex(self.df_places["lat"], self.df_places["lon"])
+
+
+class SessionStore:
+    def __init__(self, cache, expire: float = 86400):
+        self.cache = cache
+        self.expire = expire
+
+    @staticmethod
+    def new_key(user: int) -> str:
+        return f"{uuid4().hex}:{user}"
+
+    def put(self, key: str, value) -> None:
+        self.cache.set(f"session:{key}", value, expire=self.expire)
+
+    def get(self, key: str):
+        if key is None:
+            return None
+        return self.cache.get(f"session:{key}")
+
+    def mark_latest(self, key: str, token: int) -> None:
+        """Records `token`, increasing with every request of session `key`
+        (e.g. a click count), unless a newer request already started"""
+        with self.cache.transact():
+            latest = self.cache.get(f"latest:{key}")
+            if latest is None or token > latest:
+                self.cache.set(f"latest:{key}", token, expire=self.expire)
+
+    def is_latest(self, key: str, token: int) -> bool:
+        """Whether no request came after the one of `token`, which may have
+        been recorded by another process"""
+        return self.cache.get(f"latest:{key}", token) <= token
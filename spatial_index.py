@@ -0,0 +1,135 @@
+"""
+spatial_index.py: KD-tree over place coordinates
+
+Answers bounding-box and radius queries with the positions of the matching
+points. The tree only proposes candidates; membership is then decided on the
+stored coordinates with the same comparisons the full scans used, so the
+results do not depend on floating-point rounding inside the tree.
+
+Radius queries also accept the geographic metrics of `metrics.METRICS`, with
+the radius in km. The tree, which works in degrees, is then asked for the
+latitude/longitude box enclosing that radius, shifted by 360 degrees when
+the box crosses the antimeridian.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from metrics import EARTH_RADIUS, METRICS, distance_to_many
+
+# margin (degrees) added to tree queries so no boundary point is missed
+QUERY_SLACK = 1e-4
+
+
+class SpatialIndex:
+    def __init__(self, lat, lon):
+        self.lat = np.asarray(lat)
+        self.lon = np.asarray(lon)
+        self._tree = cKDTree(
+            np.column_stack([self.lat, self.lon]).astype(np.float64)
+        )
+
+    def __len__(self):
+        return len(self.lat)
+
+    def query_bbox(self, lat1, lon1, lat2, lon2) -> np.ndarray:
+        """Sorted positions of points with lat1 <= lat <= lat2 and
+        lon1 <= lon <= lon2"""
+        if len(self) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        center = [(lat1 + lat2) / 2, (lon1 + lon2) / 2]
+        half_extent = max(lat2 - lat1, lon2 - lon1) / 2
+        candidate = np.array(
+            self._tree.query_ball_point(
+                center, half_extent + QUERY_SLACK, p=np.inf
+            ),
+            dtype=np.int64,
+        )
+
+        cand_lat = self.lat[candidate]
+        cand_lon = self.lon[candidate]
+        is_inside = (
+            (cand_lat >= lat1)
+            & (cand_lat <= lat2)
+            & (cand_lon >= lon1)
+            & (cand_lon <= lon2)
+        )
+        return np.sort(candidate[is_inside])
+
+    def query_radius(self, lat, lon, radius, metric="planar") -> np.ndarray:
+        """Sorted positions of points whose distance to (lat, lon) is not
+        greater than `radius`"""
+        if len(self) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        if metric == "planar":
+            candidate = np.array(
+                self._tree.query_ball_point(
+                    [lat, lon], radius * (1 + QUERY_SLACK) + QUERY_SLACK
+                ),
+                dtype=np.int64,
+            )
+            is_far = (
+                distance_to_many(
+                    lat, lon, self.lat[candidate], self.lon[candidate]
+                )
+                > radius
+            )
+            return np.sort(candidate[~is_far])
+
+        if METRICS[metric][1] != "km":
+            raise ValueError(f"Radius queries do not support {metric}")
+
+        dlat, dlon = self._degree_extent(lat, radius)
+        centers = [[lat, lon]]
+        if lon - dlon < -180:
+            centers.append([lat, lon + 360])
+        if lon + dlon > 180:
+            centers.append([lat, lon - 360])
+
+        candidate = np.unique(
+            np.concatenate(
+                [
+                    np.array(
+                        self._tree.query_ball_point(
+                            center,
+                            max(dlat, dlon) * (1 + QUERY_SLACK) + QUERY_SLACK,
+                            p=np.inf,
+                        ),
+                        dtype=np.int64,
+                    )
+                    for center in centers
+                ]
+            )
+        )
+        is_far = (
+            distance_to_many(
+                lat, lon, self.lat[candidate], self.lon[candidate], metric
+            )
+            > radius
+        )
+        return candidate[~is_far]
+
+    @staticmethod
+    def _degree_extent(lat, radius):
+        """Half height and half width (degrees) of the box enclosing every
+        point within `radius` km of latitude `lat`"""
+        angle = radius / EARTH_RADIUS
+        dlat = np.degrees(angle)
+        max_lat = min(abs(lat) + dlat, 90.0)
+
+        # great circle (haversine) and projected (equirectangular) bounds
+        cos_lat = np.cos(np.radians(lat))
+        cos_max_lat = np.cos(np.radians(max_lat))
+        if (
+            angle >= np.pi / 2
+            or np.sin(angle) >= cos_lat
+            or cos_max_lat < 1e-9
+        ):
+            return dlat, 180.0
+        dlon = max(
+            np.degrees(np.arcsin(np.sin(angle) / cos_lat)),
+            dlat / cos_max_lat,
+        )
+        return dlat, min(dlon, 180.0)
@@ -0,0 +1,89 @@
+"""
+viewport.py: Map viewports as [[lat1, lon1], [lat2, lon2]] bounds
+
+`quantize_bounds` snaps bounds to a grid scaled to their size, so viewports
+that differ by a few pixels share a key. `adjacent_viewports` lists the
+viewports a user is likely to ask for next: one zoom level in and out around
+the same center, and the eight neighbours reached by panning. `move_kind`
+tells which of these moves led from one viewport to the next.
+"""
+
+import numpy as np
+
+QUANTA = 16  # grid cells across the width of a viewport
+ZOOM_STEPS = 4  # quantized sizes per zoom level
+PAN_FRACTION = 0.5  # of the viewport, moved by one pan
+
+
+def center(bounds: list) -> tuple:
+    [lat1, lon1], [lat2, lon2] = bounds
+    return (lat1 + lat2) / 2, (lon1 + lon2) / 2
+
+
+def extent(bounds: list) -> tuple:
+    """(height, width) in degrees"""
+    [lat1, lon1], [lat2, lon2] = bounds
+    return lat2 - lat1, lon2 - lon1
+
+
+def from_center(lat: float, lon: float, height: float, width: float):
+    return [
+        [lat - height / 2, lon - width / 2],
+        [lat + height / 2, lon + width / 2],
+    ]
+
+
+def quantize_bounds(
+    bounds: list, quanta: int = QUANTA, zoom_steps: int = ZOOM_STEPS
+) -> tuple:
+    """Hashable key of `bounds`: their size in steps of 1 / `zoom_steps`
+    zoom level and their center on a grid of `quanta` cells per width"""
+    height, width = extent(bounds)
+    lat, lon = center(bounds)
+    if height <= 0 or width <= 0:
+        return (None, None, lat, lon)
+
+    # the width of a Leaflet map halves every zoom level at any latitude
+    width_step = int(np.round(zoom_steps * np.log2(360 / width)))
+    height_step = int(np.round(zoom_steps * np.log2(180 / height)))
+    cell = 360 / 2 ** (width_step / zoom_steps) / quanta
+    return (
+        width_step,
+        height_step,
+        int(np.round(lat / cell)),
+        int(np.round(lon / cell)),
+    )
+
+
+def move_kind(prev_bounds: list, bounds: list) -> str:
+    """ "zoom_in" when `bounds` lie strictly inside `prev_bounds`, "zoom_out"
+    when they strictly contain them, "pan" otherwise"""
+    [lat1, lon1], [lat2, lon2] = bounds
+    [lat1p, lon1p], [lat2p, lon2p] = prev_bounds
+    if (lat1p < lat1 < lat2 < lat2p) and (lon1p < lon1 < lon2 < lon2p):
+        return "zoom_in"
+    if (lat1 < lat1p < lat2p < lat2) and (lon1 < lon1p < lon2p < lon2):
+        return "zoom_out"
+    return "pan"
+
+
+def adjacent_viewports(bounds: list, pan_fraction: float = PAN_FRACTION):
+    """{name: bounds} of the viewports one step away from `bounds`"""
+    height, width = extent(bounds)
+    lat, lon = center(bounds)
+
+    viewports = {
+        "zoom_in": from_center(lat, lon, height / 2, width / 2),
+        "zoom_out": from_center(lat, lon, height * 2, width * 2),
+    }
+    for dy, y_name in [(1, "n"), (0, ""), (-1, "s")]:
+        for dx, x_name in [(-1, "w"), (0, ""), (1, "e")]:
+            if dx == 0 and dy == 0:
+                continue
+            viewports[f"pan_{y_name}{x_name}"] = from_center(
+                lat + dy * pan_fraction * height,
+                lon + dx * pan_fraction * width,
+                height,
+                width,
+            )
+    return viewports
@@ -0,0 +1,215 @@
+"""
+visitor_matrix.py: Sparse place-by-user incidence matrix
+
+Row i of the CSR matrix holds the visitors of `place_id[i]`. Jaccard
+similarities between places are obtained from sparse matrix products
+(intersection sizes) and the row-size vector (set sizes), which yields the
+same values as `metrics.jaccard` on the visitor lists.
+
+Most pairs of places share no visitor, so `build_similarity_graph` keeps
+only the non-zero similarities between rows, and subsets slice it instead of
+recomputing it. Without the graph, `neighbors` computes them row by row.
+The graph and the transposed matrix are derived from the rows and left out of
+pickles, where they would outweigh the matrix itself many times over.
+"""
+
+from itertools import chain
+
+import numpy as np
+from scipy import sparse
+
+# entries (12 bytes each) above which the similarity graph is not stored,
+# and about the number built at once between two deadline checks
+GRAPH_MAX_NNZ = 2**24
+GRAPH_BLOCK_NNZ = 2**20
+
+
+class VisitorMatrix:
+    def __init__(self, place_id, indptr, user_id):
+        place_id = np.asarray(place_id, dtype=np.int64)
+        user_id = np.asarray(user_id, dtype=np.int64)
+
+        self.user_id, indices = np.unique(user_id, return_inverse=True)
+        matrix = sparse.csr_matrix(
+            (
+                np.ones(len(indices), dtype=np.int32),
+                indices.ravel(),
+                np.asarray(indptr, dtype=np.int64),
+            ),
+            shape=(len(place_id), len(self.user_id)),
+        )
+        matrix.sum_duplicates()
+        matrix.data[:] = 1  # a user visiting a place twice counts once
+
+        self._set_rows(place_id, matrix)
+
+    @classmethod
+    def from_dict(cls, d_visitor: dict):
+        n_place = len(d_visitor)
+        place_id = np.fromiter(d_visitor.keys(), dtype=np.int64, count=n_place)
+        n_visitor = np.fromiter(
+            (len(v) for v in d_visitor.values()), dtype=np.int64, count=n_place
+        )
+        indptr = np.concatenate([[0], np.cumsum(n_visitor)])
+        user_id = np.fromiter(
+            chain.from_iterable(d_visitor.values()),
+            dtype=np.int64,
+            count=indptr[-1],
+        )
+        return cls(place_id, indptr, user_id)
+
+    def _set_rows(self, place_id, matrix):
+        self.place_id = place_id
+        self.matrix = matrix
+        self.sizes = np.diff(matrix.indptr)  # number of visitors per row
+        self._matrix_t = None
+        self._graph = None
+
+        self._sort_idx = np.argsort(place_id, kind="stable")
+        self._sorted_id = place_id[self._sort_idx]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_matrix_t"] = None
+        state["_graph"] = None
+        return state
+
+    def __len__(self):
+        return len(self.place_id)
+
+    def __repr__(self):
+        return (
+            f"VisitorMatrix({len(self)} places, {len(self.user_id)} users, "
+            f"{self.matrix.nnz} visits)"
+        )
+
+    def rows(self, place_ids) -> np.ndarray:
+        place_ids = np.atleast_1d(np.asarray(place_ids, dtype=np.int64))
+        pos = np.searchsorted(self._sorted_id, place_ids)
+        pos = np.minimum(pos, len(self._sorted_id) - 1)
+
+        is_exist = self._sorted_id[pos] == place_ids
+        if not np.all(is_exist):
+            failed_idx = np.argmin(is_exist)
+            raise KeyError(f"Place {place_ids[failed_idx]} doesn't exist")
+
+        return self._sort_idx[pos]
+
+    def subset(self, place_ids):
+        """Returns a matrix whose rows follow the order of `place_ids`"""
+        place_ids = np.asarray(place_ids, dtype=np.int64)
+
+        rows = self.rows(place_ids)
+        new = VisitorMatrix.__new__(VisitorMatrix)
+        new.user_id = self.user_id
+        new._set_rows(place_ids, self.matrix[rows])
+        if self._graph is not None:
+            new._graph = self._graph[rows][:, rows]
+        return new
+
+    def get_visitor(self, place_id) -> np.ndarray:
+        row = self.rows(place_id)[0]
+        start, stop = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+        return self.user_id[self.matrix.indices[start:stop]]
+
+    def jaccard(self, rows) -> np.ndarray:
+        """Jaccard similarity of `rows` against every row, (len(rows), n)"""
+        if self._matrix_t is None:
+            self._matrix_t = self.matrix.T.tocsr()
+
+        rows = np.atleast_1d(rows)
+        n_intersect = (self.matrix[rows] @ self._matrix_t).toarray()
+        n_union = self.sizes[rows][:, None] + self.sizes[None, :] - n_intersect
+        return n_intersect / n_union
+
+    def jaccard_sparse(self, rows) -> sparse.coo_matrix:
+        """Same as `jaccard` but only stores the non-zero similarities, so
+        the cost follows the number of overlapping pairs"""
+        if self._matrix_t is None:
+            self._matrix_t = self.matrix.T.tocsr()
+
+        rows = np.atleast_1d(rows)
+        n_intersect = (self.matrix[rows] @ self._matrix_t).tocoo()
+        n_union = (
+            self.sizes[rows][n_intersect.row]
+            + self.sizes[n_intersect.col]
+            - n_intersect.data
+        )
+        return sparse.coo_matrix(
+            (n_intersect.data / n_union, (n_intersect.row, n_intersect.col)),
+            shape=n_intersect.shape,
+        )
+
+    def jaccard_against(self, rows, other) -> sparse.csr_matrix:
+        """Non-zero Jaccard similarities of `rows` against every row of
+        `other`, a matrix over the same users such as a `subset`"""
+        if other._matrix_t is None:
+            other._matrix_t = other.matrix.T.tocsr()
+
+        rows = np.atleast_1d(rows)
+        n_intersect = (self.matrix[rows] @ other._matrix_t).tocoo()
+        n_union = (
+            self.sizes[rows][n_intersect.row]
+            + other.sizes[n_intersect.col]
+            - n_intersect.data
+        )
+        return sparse.csr_matrix(
+            (n_intersect.data / n_union, (n_intersect.row, n_intersect.col)),
+            shape=n_intersect.shape,
+        )
+
+    def max_similar_pairs(self) -> int:
+        """Upper bound of the number of non-zero similarities, i.e. of the
+        entries of the similarity graph"""
+        n_place_per_user = np.bincount(
+            self.matrix.indices, minlength=len(self.user_id)
+        ).astype(np.int64)
+        return int(np.sum(n_place_per_user**2))
+
+    def build_similarity_graph(
+        self, max_nnz: int = GRAPH_MAX_NNZ, deadline=None
+    ) -> bool:
+        """Stores the non-zero Jaccard similarities between rows, row i of
+        the graph holding the neighbours of row i, itself included. Skipped
+        when the graph could hold more than `max_nnz` entries, and given up
+        once `deadline` (see `object_selection.Deadline`) expires between
+        two blocks of rows."""
+        if self._graph is not None:
+            return True
+        n_pairs = self.max_similar_pairs()
+        if n_pairs > max_nnz:
+            return False
+
+        degree = max(1, n_pairs // max(1, len(self)))
+        block_size = max(1, GRAPH_BLOCK_NNZ // degree)
+        blocks = []
+        for start in range(0, len(self), block_size):
+            if deadline is not None and deadline.expired():
+                return False
+            rows = np.arange(start, min(start + block_size, len(self)))
+            blocks.append(self.jaccard_sparse(rows).tocsr())
+
+        if len(blocks) == 1:
+            self._graph = blocks[0]
+        else:
+            self._graph = sparse.vstack(blocks, format="csr")
+        return True
+
+    def neighbors(self, row: int):
+        """(rows, similarities) of the rows sharing a visitor with `row`,
+        read from the graph when it was built"""
+        if self._graph is not None:
+            start, stop = self._graph.indptr[row], self._graph.indptr[row + 1]
+            return (
+                self._graph.indices[start:stop],
+                self._graph.data[start:stop],
+            )
+
+        sim = self.jaccard_sparse([row])
+        return sim.col, sim.data
+
+    def neighbor_block(self, rows) -> sparse.csr_matrix:
+        """`neighbors` of several rows, one row of the result each"""
+        if self._graph is not None:
+            return self._graph[rows]
+        return self.jaccard_sparse(rows).tocsr()